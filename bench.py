@@ -0,0 +1,280 @@
+"""Замеры горячих путей бота на mongomock или локальном mongod.
+
+    python bench.py                          # mongomock, N = 10, 100, 1000, 10000
+    python bench.py --uri mongodb://localhost:27017/ --sizes 100 1000 --output bench.json
+
+Результат - JSON с задержками и числом запросов к каждой коллекции на одну операцию.
+"""
+import argparse
+import asyncio
+import functools
+import json
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from typing import Dict, List
+
+from pymongo import monitoring
+
+os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARK")
+
+import db  # noqa: E402
+
+DB_NAME = "rabbit_manager_bench"
+DEFAULT_SIZES = [10, 100, 1000, 10000]
+CHATS = 5
+COUNTED_COMMANDS = {"find", "aggregate", "update", "insert", "delete", "findAndModify", "count", "getMore"}
+MONGOMOCK_METHODS = [
+    "find", "find_one", "update_one", "find_one_and_update", "aggregate",
+    "count_documents", "insert_one", "insert_many", "delete_one", "bulk_write",
+]
+
+
+class QueryCounter(monitoring.CommandListener):
+    """Считает запросы по коллекциям: через события pymongo или обертки над mongomock."""
+
+    def __init__(self):
+        self.counts: Counter = Counter()
+        self.enabled = True
+        self._local = threading.local()
+
+    def started(self, event):
+        if self.enabled and event.command_name in COUNTED_COMMANDS:
+            collection = event.command.get("collection") if event.command_name == "getMore" \
+                else event.command.get(event.command_name)
+            self.counts[str(collection)] += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+    def patch_mongomock(self):
+        from mongomock.collection import Collection
+
+        for name in MONGOMOCK_METHODS:
+            setattr(Collection, name, self._wrap(getattr(Collection, name)))
+
+    def _wrap(self, method):
+        counter = self
+
+        @functools.wraps(method)
+        def wrapper(collection, *args, **kwargs):
+            # mongomock вызывает свои же методы внутри, считаем только внешний вызов
+            depth = getattr(counter._local, "depth", 0)
+            if depth == 0 and counter.enabled:
+                counter.counts[collection.name] += 1
+            counter._local.depth = depth + 1
+            try:
+                return method(collection, *args, **kwargs)
+            finally:
+                counter._local.depth = depth
+
+        return wrapper
+
+    def reset(self):
+        self.counts.clear()
+
+
+class FakeMessage:
+    def __init__(self):
+        self.chat = SimpleNamespace(id=1, title=None, username="bench")
+        self.message_id = 1
+        self.edits = 0
+
+    async def edit_caption(self, *args, **kwargs):
+        self.edits += 1
+
+    async def edit_text(self, *args, **kwargs):
+        self.edits += 1
+
+    async def answer(self, *args, **kwargs):
+        pass
+
+
+class FakeCallback:
+    def __init__(self, data: str, user_id: int = 1):
+        self.data = data
+        self.from_user = SimpleNamespace(id=user_id)
+        self.message = FakeMessage()
+
+    async def answer(self, *args, **kwargs):
+        pass
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = 0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent += 1
+
+
+def seed(n: int):
+    database = db.get_db()
+    database.rabbits.delete_many({})
+    database.bot_chats.delete_many({})
+
+    rng = random.Random(n)
+    now = datetime.now()
+    males = [id for id in range(1, n + 1) if id % 2]
+    rabbits = []
+    for id in range(1, n + 1):
+        gender = "male" if id % 2 else "female"
+        last_breeding_date = None
+        if gender == "female" and rng.random() < 0.6:
+            last_breeding_date = now - timedelta(days=rng.randint(0, 40), hours=rng.randint(0, 23))
+        father = rng.choice(males) if id > 2 and rng.random() < 0.7 else None
+        rabbits.append({
+            "id": id,
+            "name": f"Кролик {id}",
+            "gender": gender,
+            "is_empty": False,
+            "last_breeding_date": last_breeding_date,
+            "father": father if father != id else None,
+        })
+    database.rabbits.insert_many(rabbits)
+    database.bot_chats.insert_many([
+        {"chat_id": 1000 + i, "chat_name": f"Чат {i}", "is_active": True} for i in range(CHATS)
+    ])
+
+
+def clear_caches():
+    from bot import pedigree_index
+    from rabbit import pedigree_cache, rabbit_cache
+
+    rabbit_cache.clear()
+    pedigree_cache.clear()
+    # Граф отцов бот держит в памяти; холодный замер подбора пары должен перечитать его из базы
+    pedigree_index.invalidate()
+
+
+def summarize(timings: List[float]) -> Dict[str, float]:
+    ordered = sorted(timings)
+    return {
+        "mean": round(statistics.mean(ordered), 3),
+        "p50": round(ordered[len(ordered) // 2], 3),
+        "p95": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 3),
+        "max": round(ordered[-1], 3),
+    }
+
+
+async def measure(name: str, n: int, repeat: int, counter: QueryCounter, warm: bool, operation, prepare=None) -> Dict:
+    timings = []
+    counter.reset()
+    for _ in range(repeat):
+        if prepare:
+            counter.enabled = False
+            prepare()
+            counter.enabled = True
+        if not warm:
+            clear_caches()
+        started = time.perf_counter()
+        await operation()
+        timings.append((time.perf_counter() - started) * 1000)
+
+    queries = {collection: round(count / repeat, 2) for collection, count in sorted(counter.counts.items())}
+    return {"scenario": name, "n": n, "repeat": repeat, "latency_ms": summarize(timings), "queries_per_op": queries}
+
+
+async def run_size(bot_module, fake_bot: FakeBot, n: int, repeat: int, counter: QueryCounter,
+                   warm: bool) -> List[Dict]:
+    from broadcast import Broadcaster
+    from scheduler import PregnancyScheduler
+
+    seed(n)
+    clear_caches()
+    female_id, male_id = 2, 1
+    router = bot_module.callback_router
+
+    def reset_female():
+        db.get_db().rabbits.update_one({"id": female_id}, {"$set": {"last_breeding_date": None}})
+
+    async def pregnancy_pass():
+        # Новый рассыльщик на каждый проход, чтобы в замер не попадали паузы лимитов Telegram
+        bot_module.broadcaster = Broadcaster(fake_bot)
+        scheduler = PregnancyScheduler(bot_module.rabbit_repository, bot_module.notify_chats)
+        await scheduler.load()
+        notifications = scheduler.pop_due()
+        if notifications:
+            await scheduler.notify(notifications)
+
+    scenarios = [
+        ("list_rabbits", lambda: router.dispatch(FakeCallback(bot_module.pack("list", 0))), None),
+        ("show_rabbit", lambda: router.dispatch(FakeCallback(bot_module.pack("rabbit", n))), None),
+        ("breed_rabbit_select", lambda: router.dispatch(FakeCallback(bot_module.pack("breed", male_id))), None),
+        ("process_breeding", lambda: router.dispatch(FakeCallback(bot_module.pack("confirm_breed", female_id, male_id))),
+         reset_female),
+        ("check_pregnant_rabbits", pregnancy_pass, None),
+        # Агрегация считает дни через $subtract, а не $dateDiff, поэтому работает и на mongomock
+        ("herd_summary", lambda: bot_module.herd_summary(FakeMessage()), None),
+    ]
+
+    results = []
+    for name, operation, prepare in scenarios:
+        results.append(await measure(name, n, repeat, counter, warm, operation, prepare))
+    return results
+
+
+async def main(args) -> Dict:
+    counter = QueryCounter()
+    if args.uri:
+        db.configure(uri=args.uri, event_listeners=[counter])
+        backend = "mongod"
+    else:
+        import mongomock
+
+        counter.patch_mongomock()
+        db.use_client(mongomock.MongoClient())
+        backend = "mongomock"
+    db.DB_NAME = DB_NAME
+
+    import logging
+    import bot as bot_module
+
+    logging.getLogger().setLevel(logging.WARNING)
+    fake_bot = FakeBot()
+
+    try:
+        db.ensure_indexes()
+        results = []
+        for n in args.sizes:
+            results.extend(await run_size(bot_module, fake_bot, n, args.repeat, counter, args.warm))
+        if args.uri:
+            db.get_client().drop_database(DB_NAME)
+    finally:
+        db.close_client()
+
+    return {
+        "backend": backend,
+        "warm_cache": args.warm,
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "results": results,
+    }
+
+
+def parse_args(argv: List[str]):
+    parser = argparse.ArgumentParser(description="Бенчмарк горячих путей бота")
+    parser.add_argument("--uri", help="mongodb:// адрес локального mongod; по умолчанию mongomock")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="сколько клеток заводить")
+    parser.add_argument("--repeat", type=int, default=20, help="повторов каждой операции")
+    parser.add_argument("--warm", action="store_true", help="не сбрасывать кэши между повторами")
+    parser.add_argument("--output", help="файл для JSON; по умолчанию stdout")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+    report = json.dumps(asyncio.run(main(args)), ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
@@ -1,17 +1,81 @@
 import logging
 import asyncio
-from aiogram import Bot, Dispatcher, types
+import os
+from aiogram import Bot, Dispatcher, F, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.filters import Command
-from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, BufferedInputFile
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from rabbit import Rabbit
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest
+from rabbit import BREEDING_INTERVAL, AsyncRabbitRepository, Rabbit, RabbitRecord, invalidate_rabbit, rabbit_cache
+from scheduler import PregnancyScheduler
+from broadcast import Broadcaster
+from media import PhotoCache, SCHEME_PATH
+from db import close_client, ensure_indexes
+from states import UserStateMiddleware, create_state_storage, in_state
+from callbacks import CallbackRouter, pack
+from webhook import WebhookServer
+from herd_io import FIELDS, detect_format, export_file, import_file
+from throttling import CallbackCoalescingMiddleware
+from metrics import HandlerTimingMiddleware, format_stats, register_mongo_listener, start_metrics_server
+from watcher import ChangeWatcher, EventBus, OpenCards
+from breeding import PARTNERS_PAGE_SIZE, RELATED_THRESHOLD, PedigreeIndex
+from events import default_event_log
+from farm_map import LEGEND, MAX_TILES, FarmMap, can_render
 from datetime import datetime
-from aiogram.types import FSInputFile
+from typing import Tuple
 
-BOT_TOKEN = "TOKEN"
+BOT_TOKEN = os.getenv("BOT_TOKEN", "TOKEN")
+STATE_STORAGE = os.getenv("STATE_STORAGE", "memory")
 
-bot = Bot(token=BOT_TOKEN)
+# polling или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+# Адрес Bot API, например локальный сервер или заглушка для тестов
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+# Обязателен при BOT_MODE=webhook: Telegram присылает его в заголовке каждого апдейта
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "8"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+# 0 отключает HTTP-сервер метрик
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+# Администраторы: /stats при пустом списке доступна всем, импорт и /export - никому
+ADMIN_IDS = {int(admin_id) for admin_id in os.getenv("ADMIN_IDS", "").split(",") if admin_id.strip()}
+# Обновлять открытые карточки клеток, когда клетку меняют из другого чата или процесса
+LIVE_CARDS = os.getenv("LIVE_CARDS", "1") == "1"
+# Как часто опрашивать базу, если change streams недоступны (mongod без replica set)
+WATCH_POLL_INTERVAL = float(os.getenv("WATCH_POLL_INTERVAL", "5"))
+
+if TELEGRAM_API_URL:
+    bot = Bot(
+        token=BOT_TOKEN,
+        session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL))
+    )
+else:
+    bot = Bot(token=BOT_TOKEN)
 dp = Dispatcher()
+callback_router = CallbackRouter()
+open_cards = OpenCards()
+
+
+async def dispatch_callback(callback: types.CallbackQuery):
+    # Любая кнопка уводит сообщение с карточки; show_rabbit запомнит его заново
+    if callback.message:
+        open_cards.forget(callback.message.chat.id, callback.message.message_id)
+    await callback_router.dispatch(callback)
+
+dp.callback_query.register(dispatch_callback)
+
+register_mongo_listener()
+# Склейка дублей стоит раньше замеров, чтобы повторные нажатия не попадали в статистику
+dp.callback_query.middleware(CallbackCoalescingMiddleware())
+handler_timing = HandlerTimingMiddleware(callback_router)
+dp.message.middleware(handler_timing)
+dp.callback_query.middleware(handler_timing)
 
 logging.basicConfig(level=logging.INFO)
 
@@ -19,8 +83,20 @@ class State:
     ADD_NAME = 1
     ADD_GENDER = 2
     ADD_FATHER = 3
+    BREED_SELECT = 4
+    ADD_LITTER = 5
+
+LIST_PAGE_SIZE = 10
+
+user_states = create_state_storage(STATE_STORAGE)
+dp.message.outer_middleware(UserStateMiddleware(user_states))
 
-user_states = {}
+rabbit_repository = AsyncRabbitRepository()
+photo_cache = PhotoCache(rabbit_repository)
+farm_map = FarmMap()
+FARM_MAP_KEY = "farm_map"
+pedigree_index = PedigreeIndex()
+event_log = default_event_log
 
 @dp.message(Command("start"))
 async def start_command_handler(message: types.Message):
@@ -28,136 +104,298 @@ async def start_command_handler(message: types.Message):
         message.chat.username if hasattr(message.chat, 'username') else "Личный чат"
     )
     
-    Rabbit.register_chat(message.chat.id, chat_name)
+    await rabbit_repository.register_chat(message.chat.id, chat_name)
     
     kb = [
-        [InlineKeyboardButton(text="📋 Список кроликов", callback_data="list_rabbits")],
-        [InlineKeyboardButton(text="➕ Добавить кролика", callback_data="add_rabbit")]
+        [InlineKeyboardButton(text="📋 Список кроликов", callback_data=pack("list", 0))],
+        [InlineKeyboardButton(text="➕ Добавить кролика", callback_data=pack("add"))],
+        [InlineKeyboardButton(text="🗺 Карта фермы", callback_data=pack("map"))]
     ]
     keyboard = InlineKeyboardMarkup(inline_keyboard=kb)
     
-    await message.answer_photo(
+    await photo_cache.answer_file(
+        message,
+        SCHEME_PATH,
         caption="🐰 Бот для учета кроликов\nВыберите действие:",
-        photo=FSInputFile("scheme.png"),
         reply_markup=keyboard
     )
 
-@dp.callback_query(lambda c: c.data == "list_rabbits")
-async def list_rabbits(callback: types.CallbackQuery):
-    empty_rabbit = Rabbit(0)
-    rabbits = empty_rabbit.rabbits_data.find({})
+async def send_farm_map(message: types.Message):
+    if not can_render():
+        await photo_cache.answer_file(message, SCHEME_PATH, caption="🗺 Схема фермы")
+        return
+
+    rabbits = await rabbit_repository.find_records({})
+    states = farm_map.states(rabbits)
+
+    async def render():
+        _, png = await farm_map.render_async(states)
+        return BufferedInputFile(png, filename="farm_map.png")
+
+    caption = f"🗺 Карта фермы\n{LEGEND}"
+    if len(rabbits) > MAX_TILES:
+        caption += f"\nПоказаны первые {MAX_TILES} клеток из {len(rabbits)}"
+    # Версия - хэш состояния клеток, поэтому неизменившаяся карта не загружается повторно
+    await photo_cache.answer_photo(message, FARM_MAP_KEY, render, version=farm_map.version(states), caption=caption)
+
+@dp.message(Command("map"))
+async def map_command(message: types.Message):
+    await send_farm_map(message)
+
+@callback_router.route("map")
+async def show_farm_map(callback: types.CallbackQuery):
+    await send_farm_map(callback.message)
+    await callback.answer()
+
+SUMMARY_TITLES = {
+    "okrol": "⚠️ Окрол в ближайшие дни",
+    "preparing": "⏳ Готовятся к окролу",
+    "bred": "💞 Недавно случены",
+    "ready": "✅ Готовы к случке",
+}
+# days_left значит разное: для okrol это остаток окна окрола, для остальных - дни до окрола
+SUMMARY_DAYS = {
+    "okrol": "окно окрола еще ~{} дн.",
+    "preparing": "до окрола ~{} дн.",
+    "bred": "до окрола ~{} дн.",
+}
+
+@dp.message(Command("summary"))
+async def herd_summary(message: types.Message):
+    summary = await rabbit_repository.get_herd_summary()
+    
+    lines = ["📊 Сводка по самкам:"]
+    for status, title in SUMMARY_TITLES.items():
+        group = summary[status]
+        lines.append(f"\n{title}: {group['count']}")
+        for female in group["females"]:
+            days_info = f", {SUMMARY_DAYS[status].format(female['days_left'])}" if status in SUMMARY_DAYS else ""
+            # С 30-го дня самка уже готова к новой случке, но в сводке остается среди окролов
+            if status == "okrol" and female["days"] >= BREEDING_INTERVAL.days:
+                days_info += ", уже готова к случке"
+            lines.append(f"  • {female['name']} (клетка {female['id']}){days_info}")
+        if group["count"] > len(group["females"]):
+            lines.append(f"  … и еще {group['count'] - len(group['females'])}")
+    
+    await message.answer("\n".join(lines))
+
+LITTERS_LIMIT = 60
+
+@dp.message(Command("litters"))
+async def litters_command(message: types.Message):
+    # Последние 12 месяцев, считая текущий
+    now = datetime.now()
+    year, month = (now.year - 1, now.month + 1) if now.month < 12 else (now.year, 1)
+    rows = await event_log.litters_per_month(start=datetime(year, month, 1))
+    
+    if not rows:
+        await message.answer("За последний год окролов не записано")
+        return
+    
+    lines = ["🐣 Окролы по месяцам:"]
+    for row in rows[:LITTERS_LIMIT]:
+        lines.append(f"{row['year']}-{row['month']:02d}, клетка {row['cage']}: {row['litters']} окр., {row['born']} крольчат")
+    if len(rows) > LITTERS_LIMIT:
+        lines.append(f"… и еще {len(rows) - LITTERS_LIMIT}")
+    await message.answer("\n".join(lines))
+
+def is_admin(user_id: int, allow_if_unset: bool = True) -> bool:
+    # Без ADMIN_IDS открыта только статистика; импорт и выгрузка тогда закрыты для всех
+    if not ADMIN_IDS:
+        return allow_if_unset
+    return user_id in ADMIN_IDS
+
+@dp.message(Command("stats"))
+async def stats_command(message: types.Message):
+    if not is_admin(message.from_user.id):
+        await message.answer("Команда доступна только администраторам")
+        return
+    
+    cache = rabbit_cache.stats()
+    await message.answer(
+        format_stats() +
+        f"\n\nКэш карточек: {cache['hits']} попаданий, {cache['misses']} промахов, {cache['size']} записей"
+    )
+
+@dp.message(Command("export"))
+async def export_herd(message: types.Message):
+    if not is_admin(message.from_user.id, allow_if_unset=False):
+        await message.answer("Команда доступна только администраторам")
+        return
+    
+    data = await rabbit_repository.run(export_file, "csv")
+    await message.answer_document(
+        BufferedInputFile(data, filename=f"rabbits_{datetime.now().strftime('%Y-%m-%d')}.csv"),
+        caption="📤 Выгрузка всех клеток"
+    )
+
+@dp.message(F.document)
+async def import_herd(message: types.Message):
+    # В группах присылают любые файлы: на чужие форматы и от не-администраторов молчим
+    filename = message.document.file_name or ""
+    try:
+        detect_format(filename)
+    except ValueError:
+        return
+    if not is_admin(message.from_user.id, allow_if_unset=False):
+        return
+    
+    try:
+        file = await bot.download(message.document)
+        result = await rabbit_repository.run(import_file, file, filename)
+    except Exception as e:
+        logging.error(f"Ошибка при импорте {filename}: {e}")
+        await message.answer(
+            f"⚠️ Не удалось импортировать файл: {e}\n"
+            "Нужен .csv, .jsonl или .json с полями: " + ", ".join(FIELDS)
+        )
+        return
+    finally:
+        # Даже прерванный импорт мог записать часть пачек
+        await pregnancy_scheduler.load()
+        pedigree_index.invalidate()
+    
+    text = f"📥 Импортировано клеток: {result['imported']}"
+    if result["errors"]:
+        text += "\n\nОшибки:\n" + "\n".join(result["errors"])
+    await message.answer(text)
 
-    if not rabbits:
+@callback_router.route("list", int)
+async def list_rabbits(callback: types.CallbackQuery, page: int):
+    rabbits, total = await rabbit_repository.list_page(page, LIST_PAGE_SIZE)
+
+    if not total:
         builder = InlineKeyboardBuilder()
         builder.add(InlineKeyboardButton(
             text="➕ Добавить кролика",
-            callback_data="add_rabbit"
+            callback_data=pack("add")
         ))
         builder.add(InlineKeyboardButton(
             text="🔙 В меню",
-            callback_data="menu"
+            callback_data=pack("menu")
         ))
         builder.adjust(1)
         
-        await callback.message.edit_text(
-            "📋 Список кроликов пуст!",
+        await callback.message.edit_caption(
+            caption="📋 Список кроликов пуст!",
             reply_markup=builder.as_markup()
         )
     else:
         builder = InlineKeyboardBuilder()
         
-        for rabbit in sorted(rabbits, key=lambda x: x.get("id", 0)):
-            if rabbit.get("is_empty", True): continue
-            gender_emoji = "♂️" if rabbit.get("gender") == "male" else "♀️"
-            name = rabbit.get("name", "Без имени")
-            cell_id = rabbit.get("id", "?")
+        for rabbit in rabbits:
+            gender_emoji = "♂️" if rabbit.gender == "male" else "♀️"
+            name = rabbit.name or "Без имени"
             
-            builder.add(InlineKeyboardButton(
-                text=f"{name} {gender_emoji} (клетка {cell_id})",
-                callback_data=f"rabbit_{cell_id}"
+            builder.row(InlineKeyboardButton(
+                text=f"{name} {gender_emoji} (клетка {rabbit.id})",
+                callback_data=pack("rabbit", rabbit.id)
             ))
         
-        builder.add(InlineKeyboardButton(
+        pages = (total + LIST_PAGE_SIZE - 1) // LIST_PAGE_SIZE
+        if pages > 1:
+            navigation = []
+            if page > 0:
+                navigation.append(InlineKeyboardButton(text="⬅️", callback_data=pack("list", page - 1)))
+            navigation.append(InlineKeyboardButton(text=f"{page + 1}/{pages}", callback_data=pack("noop")))
+            if page < pages - 1:
+                navigation.append(InlineKeyboardButton(text="➡️", callback_data=pack("list", page + 1)))
+            builder.row(*navigation)
+        
+        builder.row(InlineKeyboardButton(
             text="🔙 В меню",
-            callback_data="menu"
+            callback_data=pack("menu")
         ))
         
-        builder.adjust(1)
-        
         await callback.message.edit_caption(
-            caption="📋 Список кроликов:",
+            caption=f"📋 Список кроликов ({total}):",
             reply_markup=builder.as_markup()
         )
     
     await callback.answer()
 
-@dp.callback_query(lambda c: c.data.startswith("rabbit_"))
-async def show_rabbit(callback: types.CallbackQuery):
-    rabbit_id = int(callback.data.split("_")[1])
-    rabbit = Rabbit(rabbit_id)
-    
+@callback_router.route("noop")
+async def noop(callback: types.CallbackQuery):
+    # Кнопки-подписи вроде номера страницы: повторное редактирование Telegram отклонит
+    await callback.answer()
+
+@callback_router.route("rabbit", int)
+async def show_rabbit(callback: types.CallbackQuery, rabbit_id: int):
+    rabbit = await rabbit_repository.get(rabbit_id)
+    caption, reply_markup = build_rabbit_card(rabbit)
+
+    await callback.message.edit_caption(caption=caption, reply_markup=reply_markup)
+    open_cards.track(callback.message.chat.id, callback.message.message_id, rabbit_id)
+    await callback.answer()
+
+
+def build_rabbit_card(rabbit: Rabbit) -> Tuple[str, InlineKeyboardMarkup]:
+    rabbit_id = rabbit.id
     builder = InlineKeyboardBuilder()
     
     if not rabbit.is_empty:
         builder.add(InlineKeyboardButton(
             text="💞 Случить",
-            callback_data=f"breed_{rabbit_id}"
+            callback_data=pack("breed", rabbit_id)
         ))
         
         if rabbit.gender == "female" and rabbit.last_breeding_date:
+            builder.add(InlineKeyboardButton(
+                text="🐣 Записать окрол",
+                callback_data=pack("litter", rabbit_id)
+            ))
             builder.add(InlineKeyboardButton(
                 text="🔄 Сбросить случку",
-                callback_data=f"reset_breed_{rabbit_id}"
+                callback_data=pack("reset_breed", rabbit_id)
             ))
         
         builder.add(InlineKeyboardButton(
             text="✏️ Редактировать",
-            callback_data=f"edit_{rabbit_id}"
+            callback_data=pack("edit", rabbit_id)
         ))
         builder.add(InlineKeyboardButton(
             text="🗑️ Удалить",
-            callback_data=f"delete_{rabbit_id}"
+            callback_data=pack("delete", rabbit_id)
         ))
     
+    builder.add(InlineKeyboardButton(
+        text="📜 История",
+        callback_data=pack("history", rabbit_id)
+    ))
     builder.add(InlineKeyboardButton(
         text="🔙 Назад",
-        callback_data="list_rabbits"
+        callback_data=pack("list", 0)
     ))
     builder.adjust(1)
-    
-    await callback.message.edit_caption(
-        caption=rabbit.get_message(),
-        reply_markup=builder.as_markup()
-    )
-    await callback.answer()
+    return rabbit.get_message(), builder.as_markup()
 
 
-@dp.callback_query(lambda c: c.data == "add_rabbit")
+@callback_router.route("add")
 async def add_rabbit_start(callback: types.CallbackQuery):
-    user_states[callback.from_user.id] = {"state": State.ADD_NAME}
+    await user_states.set(callback.from_user.id, {"state": State.ADD_NAME})
     
     await callback.message.edit_caption(
         caption="Введите номер клетки для нового кролика:",
         reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🔙 Отмена", callback_data="cancel")]
+            [InlineKeyboardButton(text="🔙 Отмена", callback_data=pack("cancel"))]
         ])
     )
     await callback.answer()
 
-@dp.message(lambda message: user_states.get(message.from_user.id, {}).get("state") == State.ADD_NAME)
-async def add_rabbit_name(message: types.Message):
-    user_state = user_states[message.from_user.id]
+@dp.message(in_state(State.ADD_NAME))
+async def add_rabbit_name(message: types.Message, user_state: dict):
     try:
         cell_id = int(message.text)
         user_state["cell_id"] = cell_id
         user_state["state"] = State.ADD_GENDER
+        await user_states.set(message.from_user.id, user_state)
         
         kb = InlineKeyboardMarkup(inline_keyboard=[
             [
-                InlineKeyboardButton(text="♂️ Самец", callback_data="gender_male"),
-                InlineKeyboardButton(text="♀️ Самка", callback_data="gender_female")
+                InlineKeyboardButton(text="♂️ Самец", callback_data=pack("gender", "male")),
+                InlineKeyboardButton(text="♀️ Самка", callback_data=pack("gender", "female"))
             ],
-            [InlineKeyboardButton(text="🔙 Отмена", callback_data="cancel")]
+            [InlineKeyboardButton(text="🔙 Отмена", callback_data=pack("cancel"))]
         ])
         
         await message.answer(
@@ -167,32 +405,32 @@ async def add_rabbit_name(message: types.Message):
     except ValueError:
         await message.answer("Пожалуйста, введите корректный номер клетки (число)")
 
-@dp.callback_query(lambda c: c.data.startswith("gender_"))
-async def add_rabbit_gender(callback: types.CallbackQuery):
-    user_state = user_states.get(callback.from_user.id)
-    if not user_state:
+@callback_router.route("gender", str)
+async def add_rabbit_gender(callback: types.CallbackQuery, gender: str):
+    user_state = await user_states.get(callback.from_user.id)
+    if not user_state or user_state.get("state") != State.ADD_GENDER:
         await callback.answer("Сессия истекла, начните заново")
         return
     
-    gender = callback.data.split("_")[1]
     user_state["gender"] = gender
     user_state["state"] = State.ADD_FATHER
+    await user_states.set(callback.from_user.id, user_state)
     
     await callback.message.edit_text(
         "Введите имя кролика:",
         reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🔙 Отмена", callback_data="cancel")]
+            [InlineKeyboardButton(text="🔙 Отмена", callback_data=pack("cancel"))]
         ])
     )
     await callback.answer()
 
-@dp.message(lambda message: user_states.get(message.from_user.id, {}).get("state") == State.ADD_FATHER)
-async def add_rabbit_father(message: types.Message):
-    user_state = user_states[message.from_user.id]
+@dp.message(in_state(State.ADD_FATHER))
+async def add_rabbit_father(message: types.Message, user_state: dict):
     name = message.text
     
-    rabbit = Rabbit(user_state["cell_id"])
-    rabbit.update_rabbit(
+    rabbit = await rabbit_repository.get(user_state["cell_id"])
+    await rabbit_repository.update(
+        rabbit,
         name=name,
         id=user_state["cell_id"],
         gender=user_state["gender"],
@@ -201,23 +439,25 @@ async def add_rabbit_father(message: types.Message):
         last_breeding_date=None,
         father=None
     )
+    pregnancy_scheduler.schedule(rabbit)
+    pedigree_index.update(rabbit)
     
-    del user_states[message.from_user.id]
+    await user_states.delete(message.from_user.id)
     
-    await message.answer_photo(
+    await photo_cache.answer_file(
+        message,
+        SCHEME_PATH,
         caption=f"✅ Кролик {name} успешно добавлен в клетку {user_state['cell_id']}!",
-        photo=FSInputFile("scheme.png"),
         reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🔙 В меню", callback_data="menu")]
+            [InlineKeyboardButton(text="🔙 В меню", callback_data=pack("menu"))]
         ])
     )
 
-@dp.callback_query(lambda c: c.data.startswith("delete_"))
-async def delete_rabbit(callback: types.CallbackQuery):
-    rabbit_id = int(callback.data.split("_")[1])
+@callback_router.route("delete", int)
+async def delete_rabbit(callback: types.CallbackQuery, rabbit_id: int):
     
     try:
-        rabbit = Rabbit(rabbit_id)
+        rabbit = await rabbit_repository.get(rabbit_id)
         
         if rabbit.is_empty:
             await callback.answer("Клетка уже пуста!")
@@ -226,11 +466,11 @@ async def delete_rabbit(callback: types.CallbackQuery):
         builder = InlineKeyboardBuilder()
         builder.add(InlineKeyboardButton(
             text="✅ Да, очистить клетку",
-            callback_data=f"confirm_delete_{rabbit_id}"
+            callback_data=pack("confirm_delete", rabbit_id)
         ))
         builder.add(InlineKeyboardButton(
             text="❌ Нет, оставить",
-            callback_data=f"rabbit_{rabbit_id}"
+            callback_data=pack("rabbit", rabbit_id)
         ))
         
         await callback.message.edit_caption(
@@ -243,29 +483,31 @@ async def delete_rabbit(callback: types.CallbackQuery):
         await callback.message.edit_caption(
             caption="⚠️ Произошла ошибка при попытке удаления",
             reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="🔙 Назад", callback_data=f"rabbit_{rabbit_id}")]
+                [InlineKeyboardButton(text="🔙 Назад", callback_data=pack("rabbit", rabbit_id))]
             ])
         )
     
     await callback.answer()
 
-@dp.callback_query(lambda c: c.data.startswith("confirm_delete_"))
-async def confirm_delete_rabbit(callback: types.CallbackQuery):
-    rabbit_id = int(callback.data.split("_")[2])
+@callback_router.route("confirm_delete", int)
+async def confirm_delete_rabbit(callback: types.CallbackQuery, rabbit_id: int):
     
     try:
-        rabbit = Rabbit(rabbit_id)
+        rabbit = await rabbit_repository.get(rabbit_id)
         rabbit.is_empty = True
-        rabbit.save_rabbit()
+        # Событие clear пишет сам save_rabbit, и только если клетка действительно записана
+        if await rabbit_repository.save(rabbit):
+            pregnancy_scheduler.schedule(rabbit)
+            pedigree_index.update(rabbit)
 
         builder = InlineKeyboardBuilder()
         builder.add(InlineKeyboardButton(
             text="🔙 К списку кроликов",
-            callback_data="list_rabbits"
+            callback_data=pack("list", 0)
         ))
         builder.add(InlineKeyboardButton(
             text="🏠 В меню",
-            callback_data="menu"
+            callback_data=pack("menu")
         ))
         
         await callback.message.edit_caption(
@@ -278,86 +520,90 @@ async def confirm_delete_rabbit(callback: types.CallbackQuery):
         await callback.message.edit_caption(
             caption="⚠️ Произошла ошибка при очистке клетки",
             reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="🔙 Назад", callback_data=f"rabbit_{rabbit_id}")]
+                [InlineKeyboardButton(text="🔙 Назад", callback_data=pack("rabbit", rabbit_id))]
             ])
         )
     
     await callback.answer()
 
-@dp.callback_query(lambda c: c.data.startswith("breed_"))
-async def breed_rabbit_select(callback: types.CallbackQuery):
-    rabbit_id = int(callback.data.split("_")[1])
-    current_rabbit = Rabbit(rabbit_id)
-    
-    all_rabbits = list(current_rabbit.rabbits_data.find({"is_empty": False}))
+@callback_router.route("breed", int)
+async def breed_rabbit_select(callback: types.CallbackQuery, rabbit_id: int):
+    await breed_rabbit_page(callback, rabbit_id, 0)
+
+@callback_router.route("breed_page", int, int)
+async def breed_rabbit_page(callback: types.CallbackQuery, rabbit_id: int, page: int):
+    await pedigree_index.ensure_loaded(rabbit_repository)
+    current_rabbit = pedigree_index.get(rabbit_id) or await rabbit_repository.get(rabbit_id)
+    partners, total = pedigree_index.rank_partners(current_rabbit, page, PARTNERS_PAGE_SIZE)
+    if not partners and total:
+        # Кандидатов стало меньше, пока список был открыт: показываем последнюю страницу
+        page = (total - 1) // PARTNERS_PAGE_SIZE
+        partners, total = pedigree_index.rank_partners(current_rabbit, page, PARTNERS_PAGE_SIZE)
     
     builder = InlineKeyboardBuilder()
     
-    for rabbit_data in all_rabbits:
-        if rabbit_data["id"] == rabbit_id:
-            continue
-            
-        partner = Rabbit(rabbit_data["id"])
-        
-        if current_rabbit.gender != partner.gender:  # Разные полы
-            if partner.gender == "female":
-                if partner.check_rabbit():
-                    gender_emoji = "♀️" if partner.gender == "female" else "♂️"
-                    builder.add(InlineKeyboardButton(
-                        text=f"{partner.name} {gender_emoji} (клетка {partner.id})",
-                        callback_data=f"brabbit_breed_{rabbit_id}_{partner.id}"
-                    ))
-            else:
-                gender_emoji = "♀️" if partner.gender == "female" else "♂️"
-                builder.add(InlineKeyboardButton(
-                    text=f"{partner.name} {gender_emoji} (клетка {partner.id})",
-                    callback_data=f"brabbit_breed_{rabbit_id}_{partner.id}"
-                ))
+    for partner, coefficient in partners:
+        gender_emoji = "♀️" if partner.gender == "female" else "♂️"
+        warning = f" ⚠️ родство {coefficient:.1%}" if coefficient >= RELATED_THRESHOLD else ""
+        builder.add(InlineKeyboardButton(
+            text=f"{partner.name} {gender_emoji} (клетка {partner.id}){warning}",
+            callback_data=pack("breed_pick", rabbit_id, partner.id)
+        ))
     
     if builder.buttons:
-        builder.add(InlineKeyboardButton(
+        builder.adjust(1)
+        
+        pages = (total + PARTNERS_PAGE_SIZE - 1) // PARTNERS_PAGE_SIZE
+        if pages > 1:
+            navigation = []
+            if page > 0:
+                navigation.append(InlineKeyboardButton(text="⬅️", callback_data=pack("breed_page", rabbit_id, page - 1)))
+            navigation.append(InlineKeyboardButton(text=f"{page + 1}/{pages}", callback_data=pack("noop")))
+            if page < pages - 1:
+                navigation.append(InlineKeyboardButton(text="➡️", callback_data=pack("breed_page", rabbit_id, page + 1)))
+            builder.row(*navigation)
+        
+        builder.row(InlineKeyboardButton(
             text="🔙 Назад",
-            callback_data=f"rabbit_{rabbit_id}"
+            callback_data=pack("rabbit", rabbit_id)
         ))
-        builder.adjust(1)
         
         await callback.message.edit_caption(
-            caption=f"Выберите партнера для {current_rabbit.name} ({'самки' if current_rabbit.gender == 'female' else 'самца'}):",
+            caption=(
+                f"Выберите партнера для {current_rabbit.name} ({'самки' if current_rabbit.gender == 'female' else 'самца'}):"
+                + (f"\nКандидатов: {total}, сначала неродственные" if pages > 1 else "")
+            ),
             reply_markup=builder.as_markup()
         )
     else:
         await callback.message.edit_caption(
             caption="❌ Нет подходящих кроликов для случки!\nУбедитесь, что:\n- Есть кролики противоположного пола\n- Самки готовы к случке (прошло 30 дней)",
             reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="🔙 Назад", callback_data=f"rabbit_{rabbit_id}")]
+                [InlineKeyboardButton(text="🔙 Назад", callback_data=pack("rabbit", rabbit_id))]
             ])
         )
     
-    user_states[callback.from_user.id] = {
-        "state": "BREED_SELECT",
+    await user_states.set(callback.from_user.id, {
+        "state": State.BREED_SELECT,
         "rabbit_id": rabbit_id
-    }
+    })
     
     await callback.answer()
 
-@dp.callback_query(lambda c: c.data.startswith("brabbit_breed_"))
-async def breed_rabbit_confirm(callback: types.CallbackQuery):
+@callback_router.route("breed_pick", int, int)
+async def breed_rabbit_confirm(callback: types.CallbackQuery, rabbit1_id: int, rabbit2_id: int):
     try:
-        _, _, rabbit1_id, rabbit2_id = callback.data.split('_')
-        rabbit1_id = int(rabbit1_id)
-        rabbit2_id = int(rabbit2_id)
-        
-        rabbit1 = Rabbit(rabbit1_id)
-        rabbit2 = Rabbit(rabbit2_id)
+        rabbit1 = await rabbit_repository.get(rabbit1_id)
+        rabbit2 = await rabbit_repository.get(rabbit2_id)
         
         builder = InlineKeyboardBuilder()
         builder.add(InlineKeyboardButton(
             text="✅ Подтвердить случку",
-            callback_data=f"confirm_breed_{rabbit1_id}_{rabbit2_id}"
+            callback_data=pack("confirm_breed", rabbit1_id, rabbit2_id)
         ))
         builder.add(InlineKeyboardButton(
             text="❌ Отменить",
-            callback_data=f"rabbit_{rabbit1_id}"
+            callback_data=pack("rabbit", rabbit1_id)
         ))
         
         message = (
@@ -389,29 +635,23 @@ async def breed_rabbit_confirm(callback: types.CallbackQuery):
         await callback.message.edit_caption(
             caption="⚠️ Произошла ошибка при обработке запроса",
             reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="🔙 Назад", callback_data="list_rabbits")]
+                [InlineKeyboardButton(text="🔙 Назад", callback_data=pack("list", 0))]
             ])
         )
     
     await callback.answer()
 
-@dp.callback_query(lambda c: c.data.startswith("confirm_breed_"))
-async def process_breeding(callback: types.CallbackQuery):
+@callback_router.route("confirm_breed", int, int)
+async def process_breeding(callback: types.CallbackQuery, rabbit1_id: int, rabbit2_id: int):
     try:
-        _, _, rabbit1_id, rabbit2_id = callback.data.split('_')
-        rabbit1_id = int(rabbit1_id)
-        rabbit2_id = int(rabbit2_id)
-        
-        rabbit1 = Rabbit(rabbit1_id)
-        rabbit2 = Rabbit(rabbit2_id)
+        rabbit1 = await rabbit_repository.get(rabbit1_id)
+        rabbit2 = await rabbit_repository.get(rabbit2_id)
         
-        success = False
-        if rabbit1.gender != rabbit2.gender:
-            female = rabbit1 if rabbit1.gender == "female" else rabbit2
-            if female.check_rabbit():
-                female.last_breeding_date = datetime.now()
-                female.save_rabbit()
-                success = True
+        female = rabbit1 if rabbit1.gender == "female" else rabbit2
+        success = await rabbit_repository.breed(rabbit1, rabbit2)
+        if success:
+            pregnancy_scheduler.schedule(female)
+            pedigree_index.update(female)
         
         # Формируем результат
         if success:
@@ -431,12 +671,12 @@ async def process_breeding(callback: types.CallbackQuery):
         builder = InlineKeyboardBuilder()
         builder.add(InlineKeyboardButton(
             text="🔙 К списку кроликов",
-            callback_data="list_rabbits"
+            callback_data=pack("list", 0)
         ))
         if success:
             builder.add(InlineKeyboardButton(
                 text="🐰 Посмотреть самку",
-                callback_data=f"rabbit_{female.id}"
+                callback_data=pack("rabbit", female.id)
             ))
         
         await callback.message.edit_caption(
@@ -449,25 +689,91 @@ async def process_breeding(callback: types.CallbackQuery):
         await callback.message.edit_caption(
             caption="⚠️ Произошла ошибка при обработке случки",
             reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="🔙 Назад", callback_data="list_rabbits")]
+                [InlineKeyboardButton(text="🔙 Назад", callback_data=pack("list", 0))]
             ])
         )
     
     await callback.answer()
 
-@dp.callback_query(lambda c: c.data.startswith("reset_breed_"))
-async def reset_breeding_start(callback: types.CallbackQuery):
-    rabbit_id = int(callback.data.split("_")[2])
-    rabbit = Rabbit(rabbit_id)
+@callback_router.route("litter", int)
+async def add_litter_start(callback: types.CallbackQuery, rabbit_id: int):
+    await user_states.set(callback.from_user.id, {"state": State.ADD_LITTER, "rabbit_id": rabbit_id})
+    
+    await callback.message.edit_caption(
+        caption=f"Сколько крольчат родилось в клетке {rabbit_id}? Введите число:",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="🔙 Отмена", callback_data=pack("cancel"))]
+        ])
+    )
+    await callback.answer()
+
+@dp.message(in_state(State.ADD_LITTER))
+async def add_litter_size(message: types.Message, user_state: dict):
+    try:
+        born = int(message.text)
+        if born < 0:
+            raise ValueError
+    except (TypeError, ValueError):
+        await message.answer("Пожалуйста, введите количество крольчат (целое число)")
+        return
+    
+    rabbit = await rabbit_repository.get(user_state["rabbit_id"])
+    event_log.record("litter", rabbit.id, born=born, bred_at=rabbit.last_breeding_date)
+    await user_states.delete(message.from_user.id)
+    
+    await message.answer(
+        f"✅ Окрол записан: {rabbit.name} (клетка {rabbit.id}), крольчат: {born}",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="🔙 В меню", callback_data=pack("menu"))]
+        ])
+    )
+
+EVENT_TITLES = {
+    "breeding": "💞 Случка",
+    "reset": "🔄 Сброс случки",
+    "litter": "🐣 Окрол",
+    "move": "➕ Заселение",
+    "clear": "🗑️ Очистка",
+}
+HISTORY_LIMIT = 15
+
+def format_event(event: dict) -> str:
+    line = f"{event['time'].strftime('%Y-%m-%d')} {EVENT_TITLES.get(event['type'], event['type'])}"
+    if event["type"] == "breeding" and event.get("partner") is not None:
+        line += f" с клеткой {event['partner']}"
+    elif event["type"] == "litter":
+        line += f": {event.get('born', 0)} крольчат"
+    elif event["type"] in ("move", "clear") and event.get("name"):
+        line += f": {event['name']}"
+    return line
+
+@callback_router.route("history", int)
+async def show_history(callback: types.CallbackQuery, rabbit_id: int):
+    events = await event_log.find(cage=rabbit_id, limit=HISTORY_LIMIT)
+    
+    lines = [f"📜 История клетки {rabbit_id}:"]
+    lines += [format_event(event) for event in events] or ["Событий пока нет"]
+    
+    await callback.message.edit_caption(
+        caption="\n".join(lines),
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="🔙 К карточке кролика", callback_data=pack("rabbit", rabbit_id))]
+        ])
+    )
+    await callback.answer()
+
+@callback_router.route("reset_breed", int)
+async def reset_breeding_start(callback: types.CallbackQuery, rabbit_id: int):
+    rabbit = await rabbit_repository.get(rabbit_id)
     
     builder = InlineKeyboardBuilder()
     builder.add(InlineKeyboardButton(
         text="✅ Да, сбросить",
-        callback_data=f"confirm_reset_{rabbit_id}"
+        callback_data=pack("confirm_reset", rabbit_id)
     ))
     builder.add(InlineKeyboardButton(
         text="❌ Нет, оставить",
-        callback_data=f"rabbit_{rabbit_id}"
+        callback_data=pack("rabbit", rabbit_id)
     ))
     
     last_breeding = rabbit.last_breeding_date.strftime("%Y-%m-%d") if rabbit.last_breeding_date else "не было"
@@ -478,12 +784,13 @@ async def reset_breeding_start(callback: types.CallbackQuery):
     )
     await callback.answer()
 
-@dp.callback_query(lambda c: c.data.startswith("confirm_reset_"))
-async def confirm_reset_breeding(callback: types.CallbackQuery):
-    rabbit_id = int(callback.data.split("_")[2])
-    rabbit = Rabbit(rabbit_id)
+@callback_router.route("confirm_reset", int)
+async def confirm_reset_breeding(callback: types.CallbackQuery, rabbit_id: int):
+    rabbit = await rabbit_repository.get(rabbit_id)
     
-    if rabbit.reset_breeding():
+    if await rabbit_repository.reset_breeding(rabbit):
+        pregnancy_scheduler.schedule(rabbit)
+        pedigree_index.update(rabbit)
         message = f"✅ Дата случки для {rabbit.name} сброшена!\nТеперь она готова к новой случке."
     else:
         message = "❌ Ошибка! Можно сбрасывать только для самок."
@@ -491,11 +798,11 @@ async def confirm_reset_breeding(callback: types.CallbackQuery):
     builder = InlineKeyboardBuilder()
     builder.add(InlineKeyboardButton(
         text="🔙 К карточке кролика",
-        callback_data=f"rabbit_{rabbit_id}"
+        callback_data=pack("rabbit", rabbit_id)
     ))
     builder.add(InlineKeyboardButton(
         text="📋 К списку кроликов",
-        callback_data="list_rabbits"
+        callback_data=pack("list", 0)
     ))
     
     await callback.message.edit_caption(
@@ -504,67 +811,106 @@ async def confirm_reset_breeding(callback: types.CallbackQuery):
     )
     await callback.answer()
 
-@dp.callback_query(lambda c: c.data == "cancel")
+@callback_router.route("cancel")
 async def cancel_action(callback: types.CallbackQuery):
-    if callback.from_user.id in user_states:
-        del user_states[callback.from_user.id]
+    await user_states.delete(callback.from_user.id)
     
     await callback.message.edit_caption(
         caption="Действие отменено",
         reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🔙 В меню", callback_data="menu")]
+            [InlineKeyboardButton(text="🔙 В меню", callback_data=pack("menu"))]
         ])
     )
     await callback.answer()
 
-@dp.callback_query(lambda c: c.data == "menu")
+@callback_router.route("menu")
 async def back_to_menu(callback: types.CallbackQuery):
-    if callback.from_user.id in user_states:
-        del user_states[callback.from_user.id]
+    await user_states.delete(callback.from_user.id)
     
     await start_command_handler(callback.message)
     await callback.answer()
 
-async def check_pregnant_rabbits():
-    while True:
+broadcaster = Broadcaster(bot, on_blocked=rabbit_repository.deactivate_chat)
+
+async def notify_chats(notifications):
+    chats = await rabbit_repository.get_active_chats()
+    result = await broadcaster.broadcast(
+        [chat["chat_id"] for chat in chats],
+        "🐇 Уведомление о беременных самках:\n\n" + "\n\n".join(notifications)
+    )
+    logging.info(
+        f"Уведомления разосланы: {len(result['sent'])} доставлено, "
+        f"{len(result['blocked'])} чатов отключено, {len(result['failed'])} ошибок"
+    )
+
+pregnancy_scheduler = PregnancyScheduler(rabbit_repository, notify_chats)
+
+change_bus = EventBus()
+change_watcher = ChangeWatcher(change_bus, WATCH_POLL_INTERVAL)
+
+
+@change_bus.subscribe
+def on_rabbit_changed(rabbit_data):
+    # Свои записи уже сбросили кэш, здесь догоняем изменения из других процессов
+    invalidate_rabbit(rabbit_data["id"])
+    record = RabbitRecord.from_document(rabbit_data)
+    pregnancy_scheduler.schedule(record)
+    pedigree_index.update(record)
+
+
+async def refresh_open_cards(rabbit_data):
+    messages = open_cards.messages_for(rabbit_data["id"])
+    if not messages:
+        return
+
+    rabbit = await rabbit_repository.get(rabbit_data["id"])
+    caption, reply_markup = build_rabbit_card(rabbit)
+    for chat_id, message_id in messages:
         try:
-            pregnant_females = Rabbit.get_pregnant_females()
-            notifications = []
-            
-            for female in pregnant_females:
-                status = female.get_pregnancy_status()
-                if status == "okrol":
-                    notifications.append(
-                        f"⚠️ Самка {female.name} (клетка {female.id}) должна окролиться "
-                        f"в ближайшие дни! (последняя случка {female.last_breeding_date.strftime('%Y-%m-%d')})"
-                    )
-                elif status == "preparing":
-                    days_left = 28 - (datetime.now() - female.last_breeding_date).days
-                    notifications.append(
-                        f"ℹ️ Самка {female.name} (клетка {female.id}) готовится к окролу. "
-                        f"До родов осталось ~{days_left} дней."
-                    )
-            
-            if notifications:
-                
-                for admin_id in Rabbit.get_active_chats():
-                    try:
-                        await bot.send_message(
-                            admin_id["chat_id"],
-                            "🐇 Уведомление о беременных самках:\n\n" + "\n\n".join(notifications)
-                        )
-                    except Exception as e:
-                        logging.error(f"Не удалось отправить уведомление admin {admin_id}: {e}")
-            
-            await asyncio.sleep(12 * 60 * 60)
-            
-        except Exception as e:
-            logging.error(f"Ошибка в check_pregnant_rabbits: {e}")
-            await asyncio.sleep(60)
+            await bot.edit_message_caption(
+                chat_id=chat_id,
+                message_id=message_id,
+                caption=caption,
+                reply_markup=reply_markup
+            )
+        except TelegramBadRequest as e:
+            if "message is not modified" not in str(e):
+                open_cards.forget(chat_id, message_id)
+        except TelegramAPIError as e:
+            logging.warning(f"Не удалось обновить карточку клетки {rabbit.id} в чате {chat_id}: {e}")
+            open_cards.forget(chat_id, message_id)
+
+if LIVE_CARDS:
+    change_bus.subscribe(refresh_open_cards)
 
 async def main():
-    asyncio.create_task(check_pregnant_rabbits())
-    await dp.start_polling(bot)
+    if BOT_MODE == "webhook" and not WEBHOOK_SECRET:
+        raise SystemExit("BOT_MODE=webhook требует WEBHOOK_SECRET")
+    ensure_indexes()
+    await user_states.setup()
+    asyncio.create_task(pregnancy_scheduler.run())
+    watcher_task = asyncio.create_task(change_watcher.run())
+    event_log_task = asyncio.create_task(event_log.run())
+    metrics_runner = await start_metrics_server(METRICS_HOST, METRICS_PORT) if METRICS_PORT else None
+    try:
+        if BOT_MODE == "webhook":
+            server = WebhookServer(
+                dp, bot,
+                path=WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                workers=WEBHOOK_WORKERS
+            )
+            await server.run(WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_URL)
+        else:
+            await dp.start_polling(bot)
+    finally:
+        watcher_task.cancel()
+        # Отмена дописывает в базу то, что осталось в буфере журнала
+        event_log_task.cancel()
+        await asyncio.gather(event_log_task, return_exceptions=True)
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        close_client()
 
 if __name__ == "__main__":
     asyncio.run(main())
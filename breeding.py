@@ -0,0 +1,106 @@
+import asyncio
+import heapq
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+from rabbit import PEDIGREE_MAX_DEPTH, AsyncRabbitRepository, Rabbit, RabbitRecord
+
+PARTNERS_PAGE_SIZE = 10
+# Полусибсы по отцу; с этого значения пара помечается как родственная
+RELATED_THRESHOLD = 0.125
+
+
+def to_record(rabbit: Union[Rabbit, RabbitRecord]) -> RabbitRecord:
+    if isinstance(rabbit, RabbitRecord):
+        return rabbit
+    return RabbitRecord(
+        id=rabbit.id,
+        name=rabbit.name,
+        gender=rabbit.gender,
+        is_empty=rabbit.is_empty,
+        last_breeding_date=rabbit.last_breeding_date,
+        father_id=rabbit.father_id,
+    )
+
+
+class PedigreeIndex:
+    """Граф отцов в памяти: подбор пары без запросов к базе на каждого кандидата.
+
+    Матери в базе не записаны, поэтому коэффициент инбридинга потомка считается
+    по методу путей Райта только через отцовские линии: для ближайшего общего
+    предка на расстоянии i и j поколений вклад равен (1/2)^(i+j+1).
+    """
+
+    def __init__(self, max_depth: int = PEDIGREE_MAX_DEPTH):
+        self.max_depth = max_depth
+        self._records: Dict[int, RabbitRecord] = {}
+        self._loaded = False
+        self._lock = asyncio.Lock()
+
+    def load(self, rabbits: Iterable[RabbitRecord]):
+        self._records = {rabbit.id: rabbit for rabbit in rabbits}
+        self._loaded = True
+
+    def invalidate(self):
+        """Следующий подбор пары перечитает весь граф, например после импорта."""
+        self._loaded = False
+
+    async def ensure_loaded(self, repository: AsyncRabbitRepository):
+        async with self._lock:
+            if not self._loaded:
+                self.load(await repository.find_records({}))
+
+    def update(self, rabbit: Union[Rabbit, RabbitRecord]):
+        self._records[rabbit.id] = to_record(rabbit)
+
+    def get(self, id: int) -> Optional[RabbitRecord]:
+        return self._records.get(id)
+
+    def _father_id(self, id: int) -> Optional[int]:
+        rabbit = self._records.get(id)
+        return rabbit.father_id if rabbit else None
+
+    def paternal_line(self, rabbit: RabbitRecord) -> Dict[int, int]:
+        """id -> число поколений от rabbit вверх по отцам, включая саму клетку."""
+        line = {rabbit.id: 0}
+        father_id = rabbit.father_id
+        depth = 1
+        while father_id is not None and father_id not in line and depth <= self.max_depth:
+            line[father_id] = depth
+            father_id = self._father_id(father_id)
+            depth += 1
+        return line
+
+    def coefficient(self, line: Dict[int, int], partner: RabbitRecord) -> float:
+        """Коэффициент инбридинга потомка пары; line - paternal_line первого родителя."""
+        seen = set()
+        id: Optional[int] = partner.id
+        depth = 0
+        while id is not None and id not in seen and depth <= self.max_depth:
+            if id in line:
+                return 0.5 ** (line[id] + depth + 1)
+            seen.add(id)
+            id = partner.father_id if depth == 0 else self._father_id(id)
+            depth += 1
+        return 0.0
+
+    def rank_partners(self, rabbit: Union[Rabbit, RabbitRecord], page: int = 0,
+                      page_size: int = PARTNERS_PAGE_SIZE) -> Tuple[List[Tuple[RabbitRecord, float]], int]:
+        """Страница партнеров: сначала наименее родственные, затем самки, дольше всех отдыхавшие.
+
+        Возвращает пары (партнер, коэффициент) и общее число подходящих кандидатов.
+        """
+        rabbit = to_record(rabbit)
+        line = self.paternal_line(rabbit)
+        candidates = [
+            partner for partner in self._records.values()
+            if partner.id != rabbit.id and not partner.is_empty and partner.gender != rabbit.gender
+            and (partner.gender != "female" or partner.check_rabbit())
+        ]
+        scored = ((self.coefficient(line, partner), partner) for partner in candidates)
+        # Первые страницы смотрят чаще всего, поэтому полную сортировку не делаем
+        best = heapq.nsmallest(
+            (page + 1) * page_size, scored,
+            key=lambda item: (item[0], item[1].last_breeding_date or datetime.min, item[1].id)
+        )[page * page_size:]
+        return [(partner, coefficient) for coefficient, partner in best], len(candidates)
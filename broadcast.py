@@ -0,0 +1,111 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+
+from cache import LRUCache
+
+# Лимиты Telegram: ~30 сообщений в секунду на бота, 1 в секунду в личный чат, 20 в минуту в группу
+GLOBAL_RATE = 25
+PRIVATE_CHAT_RATE = 1
+GROUP_CHAT_RATE = 20 / 60
+BROADCAST_CONCURRENCY = 10
+MAX_RETRIES = 3
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        async with self._lock:
+            self._refill()
+            while self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                self._refill()
+            self._tokens -= 1
+
+    def try_acquire(self) -> bool:
+        """Забирает токен без ожидания; False, если ведро пустое."""
+        self._refill()
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+
+class Broadcaster:
+    """Рассылка одного текста по многим чатам с ограничением параллельности и частоты."""
+
+    def __init__(self, bot: Bot, concurrency: int = BROADCAST_CONCURRENCY,
+                 on_blocked: Optional[Callable[[int], Awaitable]] = None):
+        self.bot = bot
+        self.concurrency = concurrency
+        self.on_blocked = on_blocked
+        self._global_bucket = TokenBucket(GLOBAL_RATE, capacity=GLOBAL_RATE)
+        self._chat_buckets = LRUCache(maxsize=10000)
+        self._resume_at = 0.0
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            # У групп и каналов отрицательный chat_id
+            bucket = TokenBucket(GROUP_CHAT_RATE if chat_id < 0 else PRIVATE_CHAT_RATE)
+            self._chat_buckets.set(chat_id, bucket)
+        return bucket
+
+    async def send(self, chat_id: int, text: str) -> str:
+        for _ in range(MAX_RETRIES):
+            delay = self._resume_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            await self._chat_bucket(chat_id).acquire()
+            await self._global_bucket.acquire()
+
+            try:
+                await self.bot.send_message(chat_id, text)
+                return "sent"
+            except TelegramRetryAfter as e:
+                logging.warning(f"Telegram просит подождать {e.retry_after} с перед отправкой в {chat_id}")
+                self._resume_at = max(self._resume_at, time.monotonic() + e.retry_after)
+            except (TelegramForbiddenError, TelegramBadRequest) as e:
+                if isinstance(e, TelegramBadRequest) and "chat not found" not in e.message.lower():
+                    logging.error(f"Не удалось отправить уведомление в чат {chat_id}: {e}")
+                    return "failed"
+                logging.info(f"Чат {chat_id} недоступен, отключаем уведомления: {e}")
+                if self.on_blocked:
+                    await self.on_blocked(chat_id)
+                return "blocked"
+            except Exception as e:
+                logging.error(f"Не удалось отправить уведомление в чат {chat_id}: {e}")
+                return "failed"
+
+        return "failed"
+
+    async def broadcast(self, chat_ids: Iterable[int], text: str) -> Dict[str, List[int]]:
+        semaphore = asyncio.Semaphore(self.concurrency)
+        chat_ids = list(chat_ids)
+
+        async def send_one(chat_id: int) -> str:
+            async with semaphore:
+                return await self.send(chat_id, text)
+
+        statuses = await asyncio.gather(*(send_one(chat_id) for chat_id in chat_ids))
+
+        result: Dict[str, List[int]] = {"sent": [], "blocked": [], "failed": []}
+        for chat_id, status in zip(chat_ids, statuses):
+            result[status].append(chat_id)
+        return result
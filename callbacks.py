@@ -0,0 +1,68 @@
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from aiogram.types import CallbackQuery
+
+SEPARATOR = ":"
+MAX_CALLBACK_DATA = 64
+
+CallbackHandler = Callable[..., Awaitable]
+
+
+def pack(action: str, *fields) -> str:
+    """Собирает callback_data вида action:field1:field2."""
+    data = SEPARATOR.join([action, *map(str, fields)])
+    if len(data.encode()) > MAX_CALLBACK_DATA:
+        raise ValueError(f"callback_data длиннее {MAX_CALLBACK_DATA} байт: {data}")
+    return data
+
+
+def unpack(data: str) -> Tuple[str, List[str]]:
+    action, *fields = data.split(SEPARATOR)
+    return action, fields
+
+
+class CallbackRouter:
+    """Таблица action -> обработчик: данные кнопки разбираются один раз, поиск по словарю."""
+
+    def __init__(self):
+        self.routes: Dict[str, Tuple[CallbackHandler, Tuple[type, ...]]] = {}
+
+    def route(self, action: str, *field_types: type):
+        if SEPARATOR in action:
+            raise ValueError(f"Имя действия не может содержать '{SEPARATOR}': {action}")
+
+        def decorator(handler: CallbackHandler) -> CallbackHandler:
+            if action in self.routes:
+                raise ValueError(f"Действие {action} уже зарегистрировано")
+            self.routes[action] = (handler, field_types)
+            return handler
+
+        return decorator
+
+    def resolve(self, data: Optional[str]) -> Optional[Tuple[str, CallbackHandler, list]]:
+        if not data:
+            return None
+
+        action, fields = unpack(data)
+        route = self.routes.get(action)
+        if route is None:
+            return None
+
+        handler, field_types = route
+        if len(fields) != len(field_types):
+            return None
+        try:
+            return action, handler, [field_type(field) for field_type, field in zip(field_types, fields)]
+        except ValueError:
+            return None
+
+    async def dispatch(self, callback: CallbackQuery):
+        resolved = self.resolve(callback.data)
+        if resolved is None:
+            logging.info(f"Неизвестная кнопка: {callback.data}")
+            await callback.answer("Кнопка устарела или действие недоступно")
+            return
+
+        _, handler, fields = resolved
+        return await handler(callback, *fields)
@@ -0,0 +1,160 @@
+import asyncio
+import contextvars
+import functools
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Callable, Dict, Optional
+
+from pymongo import ASCENDING
+from pymongo.database import Database
+from pymongo.mongo_client import MongoClient
+
+MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017/")
+DB_NAME = os.getenv("MONGO_DB", "rabbit_manager")
+MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "20"))
+MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "0"))
+
+_client: Optional[MongoClient] = None
+_executor: Optional[ThreadPoolExecutor] = None
+_options = {
+    "uri": MONGO_URI,
+    "maxPoolSize": MAX_POOL_SIZE,
+    "minPoolSize": MIN_POOL_SIZE,
+}
+_lock = threading.Lock()
+
+
+def configure(uri: Optional[str] = None, max_pool_size: Optional[int] = None,
+              min_pool_size: Optional[int] = None, **options):
+    """Меняет параметры подключения. Вызывать до первого обращения к базе."""
+    with _lock:
+        if _client is not None:
+            raise RuntimeError("MongoClient уже создан, настройки нужно менять до подключения")
+        if uri is not None:
+            _options["uri"] = uri
+        if max_pool_size is not None:
+            _options["maxPoolSize"] = max_pool_size
+        if min_pool_size is not None:
+            _options["minPoolSize"] = min_pool_size
+        _options.update(options)
+
+
+def use_client(client: MongoClient):
+    """Подменяет общий клиент, например на mongomock в бенчмарках."""
+    global _client
+    with _lock:
+        _client = client
+
+
+def get_client() -> MongoClient:
+    """Общий на весь процесс клиент, создается при первом обращении."""
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                options = dict(_options)
+                uri = options.pop("uri")
+                _client = MongoClient(uri, **options)
+    return _client
+
+
+def get_db() -> Database:
+    return get_client()[DB_NAME]
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """Пул потоков для синхронного pymongo, по размеру совпадает с пулом соединений."""
+    global _executor
+    if _executor is None:
+        with _lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=_options["maxPoolSize"] or MAX_POOL_SIZE,
+                    thread_name_prefix="mongo"
+                )
+    return _executor
+
+
+async def run_in_db_thread(func: Callable, *args, **kwargs) -> Any:
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(
+        get_executor(),
+        functools.partial(context.run, func, *args, **kwargs)
+    )
+
+
+def close_client():
+    global _client, _executor
+    with _lock:
+        if _executor is not None:
+            _executor.shutdown(wait=True)
+            _executor = None
+        if _client is not None:
+            _client.close()
+            _client = None
+
+
+def ensure_indexes(db: Optional[Database] = None):
+    """Создает индексы для всех рабочих запросов. Повторный вызов ничего не меняет."""
+    db = db if db is not None else get_db()
+
+    db.rabbits.create_index([("id", ASCENDING)], unique=True, name="id_unique")
+    db.rabbits.create_index(
+        [("gender", ASCENDING), ("is_empty", ASCENDING), ("last_breeding_date", ASCENDING)],
+        name="pregnancy"
+    )
+    db.rabbits.create_index([("is_empty", ASCENDING), ("id", ASCENDING)], name="occupied_by_id")
+    db.rabbits.create_index([("updated_at", ASCENDING)], name="updated_at")
+    db.bot_chats.create_index([("chat_id", ASCENDING)], unique=True, name="chat_id_unique")
+    db.bot_files.create_index([("key", ASCENDING)], unique=True, name="key_unique")
+    db.events.create_index([("cage", ASCENDING), ("time", ASCENDING)], name="cage_time")
+    db.events.create_index([("type", ASCENDING), ("time", ASCENDING)], name="type_time")
+
+
+# Запросы бота, для которых полезно смотреть план выполнения
+QUERY_SAMPLES = {
+    "rabbit_by_id": ("rabbits", {"id": 1}),
+    "occupied_list": ("rabbits", {"is_empty": False}),
+    "pregnant_females": ("rabbits", {"gender": "female", "is_empty": False, "last_breeding_date": {"$ne": None}}),
+    "chat_by_id": ("bot_chats", {"chat_id": 1}),
+    "cage_history": ("events", {"cage": 1, "time": {"$gte": datetime(2024, 1, 1)}}),
+    "litters_by_time": ("events", {"type": "litter", "time": {"$gte": datetime(2024, 1, 1)}}),
+}
+
+
+def _plan_stages(plan: Dict) -> str:
+    stage = plan.get("stage", "?")
+    if plan.get("indexName"):
+        stage += f"({plan['indexName']})"
+    children = [plan["inputStage"]] if "inputStage" in plan else plan.get("inputStages", [])
+    if children:
+        stage += " <- " + ", ".join(_plan_stages(child) for child in children)
+    return stage
+
+
+def explain_queries(db: Optional[Database] = None) -> Dict[str, str]:
+    db = db if db is not None else get_db()
+    plans = {}
+    for name, (collection, query) in QUERY_SAMPLES.items():
+        explanation = db[collection].find(query).explain()
+        plans[name] = _plan_stages(explanation["queryPlanner"]["winningPlan"])
+    return plans
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "explain"
+    try:
+        if command == "indexes":
+            ensure_indexes()
+            print("Индексы созданы")
+        elif command == "explain":
+            for name, plan in explain_queries().items():
+                print(f"{name}: {plan}")
+        else:
+            print("Использование: python db.py [indexes|explain]")
+    finally:
+        close_client()
@@ -0,0 +1,163 @@
+import asyncio
+import logging
+import threading
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import PyMongoError
+
+from db import get_db, run_in_db_thread
+
+EVENT_TYPES = ("breeding", "reset", "litter", "move", "clear")
+FLUSH_INTERVAL = 2
+FLUSH_SIZE = 100
+# Буфер не растет бесконечно, если база недоступна долго
+MAX_BUFFER = 10000
+QUERY_LIMIT = 100
+
+
+def _time_range(start: Optional[datetime], end: Optional[datetime]) -> Dict:
+    condition = {}
+    if start:
+        condition["$gte"] = start
+    if end:
+        condition["$lt"] = end
+    return condition
+
+
+def state_events(cage: int, before: Optional[Dict], after: Dict, time: Optional[datetime] = None) -> List[Dict]:
+    """События, которые следуют из смены документа клетки before -> after (before=None - новая клетка)."""
+    time = time or datetime.now()
+    before = before or {"is_empty": True}
+    events = []
+
+    was_empty = before.get("is_empty", True)
+    is_empty = after.get("is_empty", was_empty)
+    if was_empty and not is_empty:
+        events.append({"type": "move", "cage": cage, "time": time,
+                       "name": after.get("name"), "gender": after.get("gender")})
+    elif not was_empty and is_empty:
+        events.append({"type": "clear", "cage": cage, "time": time, "name": before.get("name")})
+
+    if "last_breeding_date" in after:
+        previous = before.get("last_breeding_date")
+        current = after["last_breeding_date"]
+        if current != previous:
+            if current is not None:
+                events.append({"type": "breeding", "cage": cage, "time": current})
+            else:
+                events.append({"type": "reset", "cage": cage, "time": time, "previous": previous})
+
+    return events
+
+
+class EventLog:
+    """Журнал событий хозяйства в коллекции events: записи только добавляются и пишутся пачками.
+
+    Текущее состояние по-прежнему хранится в rabbits, история не мешает его чтению.
+    """
+
+    def __init__(self, flush_interval: float = FLUSH_INTERVAL, flush_size: int = FLUSH_SIZE):
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self._buffer: List[Dict] = []
+        self._lock = threading.Lock()
+        self._wakeup = asyncio.Event()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    @property
+    def events_data(self):
+        return get_db().events
+
+    def record(self, type: str, cage: int, time: Optional[datetime] = None, **data):
+        if type not in EVENT_TYPES:
+            raise ValueError(f"Неизвестный тип события: {type}")
+        self.record_many([{"type": type, "cage": cage, "time": time or datetime.now(), **data}])
+
+    def record_many(self, events: List[Dict]):
+        """Потокобезопасно: записи в rabbits идут из пула потоков базы."""
+        if not events:
+            return
+        with self._lock:
+            free = MAX_BUFFER - len(self._buffer)
+            if free < len(events):
+                logging.error(f"Буфер журнала переполнен, потеряно событий: {len(events) - max(free, 0)}")
+            self._buffer.extend(events[:max(free, 0)])
+            full = len(self._buffer) >= self.flush_size
+        if full and self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def _insert(self, events: List[Dict]):
+        self.events_data.insert_many(events, ordered=False)
+
+    async def flush(self):
+        with self._lock:
+            events, self._buffer = self._buffer, []
+        if not events:
+            return
+        try:
+            await run_in_db_thread(self._insert, events)
+        except PyMongoError as e:
+            logging.error(f"Не удалось записать {len(events)} событий: {e}")
+            # Вернем в начало буфера, порядок событий сохраняется
+            with self._lock:
+                self._buffer[:0] = events[:MAX_BUFFER - len(self._buffer)]
+
+    async def run(self):
+        self._loop = asyncio.get_running_loop()
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                await self.flush()
+        finally:
+            await self.flush()
+
+    def _find(self, cage: Optional[int], type: Optional[str], start: Optional[datetime],
+              end: Optional[datetime], limit: int) -> List[Dict]:
+        query: Dict = {}
+        if cage is not None:
+            query["cage"] = cage
+        if type is not None:
+            query["type"] = type
+        if start or end:
+            query["time"] = _time_range(start, end)
+        return list(self.events_data.find(query, {"_id": 0}).sort("time", DESCENDING).limit(limit))
+
+    async def find(self, cage: Optional[int] = None, type: Optional[str] = None,
+                   start: Optional[datetime] = None, end: Optional[datetime] = None,
+                   limit: int = QUERY_LIMIT) -> List[Dict]:
+        """События за полуинтервал [start, end), новые первыми."""
+        await self.flush()
+        return await run_in_db_thread(self._find, cage, type, start, end, limit)
+
+    def _litters_per_month(self, start: Optional[datetime], end: Optional[datetime]) -> List[Dict]:
+        match: Dict = {"type": "litter"}
+        if start or end:
+            match["time"] = _time_range(start, end)
+        return [
+            {**row["_id"], "litters": row["litters"], "born": row["born"]}
+            for row in self.events_data.aggregate([
+                {"$match": match},
+                {"$group": {
+                    "_id": {"cage": "$cage", "year": {"$year": "$time"}, "month": {"$month": "$time"}},
+                    "litters": {"$sum": 1},
+                    "born": {"$sum": {"$ifNull": ["$born", 0]}},
+                }},
+                {"$sort": {"_id.year": ASCENDING, "_id.month": ASCENDING, "_id.cage": ASCENDING}},
+            ])
+        ]
+
+    async def litters_per_month(self, start: Optional[datetime] = None,
+                                end: Optional[datetime] = None) -> List[Dict]:
+        """Окролы по самкам и месяцам: [{cage, year, month, litters, born}]."""
+        await self.flush()
+        return await run_in_db_thread(self._litters_per_month, start, end)
+
+
+# Общий журнал процесса: в него пишут Rabbit при сохранении и обработчики бота
+default_event_log = EventLog()
@@ -0,0 +1,116 @@
+import asyncio
+import hashlib
+import io
+import math
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from rabbit import RabbitRecord
+
+try:
+    from PIL import Image, ImageDraw, ImageFont
+except ImportError:  # Pillow необязателен, без него бот показывает статичную scheme.png
+    Image = ImageDraw = ImageFont = None
+
+COLUMNS = 10
+# Telegram не примет слишком большую фотографию: 40 x 40 плиток - это 2880 px по стороне
+MAX_TILES = 1600
+TILE_SIZE = 72
+PADDING = 4
+
+EMPTY_COLOR = (224, 224, 224)
+TEXT_COLOR = (33, 33, 33)
+BACKGROUND_COLOR = (255, 255, 255)
+COLORS = {
+    ("male", None): (144, 202, 249),
+    ("female", None): (248, 187, 208),
+    ("female", "bred"): (206, 147, 216),
+    ("female", "preparing"): (255, 204, 128),
+    ("female", "okrol"): (239, 154, 154),
+}
+LEGEND = "⬜ пустая  🟦 самец  🩷 самка  🟪 случена  🟧 готовится к окролу  🟥 окрол"
+
+# id, занята ли клетка, пол, статус беременности, первые буквы имени
+TileState = Tuple[int, bool, str, Optional[str], str]
+
+
+def can_render() -> bool:
+    return Image is not None
+
+
+def tile_state(rabbit: RabbitRecord) -> TileState:
+    status = None
+    if not rabbit.is_empty and rabbit.gender == "female" and rabbit.last_breeding_date:
+        status = rabbit.get_pregnancy_status() or (None if rabbit.check_rabbit() else "bred")
+    return rabbit.id, rabbit.is_empty, rabbit.gender, status, (rabbit.name or "")[:8]
+
+
+class FarmMap:
+    """Рисует схему клеток и перерисовывает только те плитки, что изменились с прошлой версии."""
+
+    def __init__(self, columns: int = COLUMNS):
+        self.min_columns = columns
+        self.columns = columns
+        # Один поток: рисование не блокирует event loop, а состояние картинки не нужно защищать
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="farm-map")
+        self._image = None
+        self._layout: List[int] = []
+        self._tiles: Dict[int, TileState] = {}
+        self._png: Optional[Tuple[str, bytes]] = None
+        self._font = None
+
+    @staticmethod
+    def version(states: List[TileState]) -> str:
+        return hashlib.sha1(repr(states).encode("utf-8")).hexdigest()
+
+    def states(self, rabbits: List[RabbitRecord]) -> List[TileState]:
+        return [tile_state(rabbit) for rabbit in sorted(rabbits, key=lambda r: r.id)[:MAX_TILES]]
+
+    def _position(self, index: int) -> Tuple[int, int]:
+        row, column = divmod(index, self.columns)
+        return column * TILE_SIZE, row * TILE_SIZE
+
+    def _draw_tile(self, draw, index: int, state: TileState):
+        id, is_empty, gender, status, name = state
+        x, y = self._position(index)
+        color = EMPTY_COLOR if is_empty else COLORS.get((gender, status), EMPTY_COLOR)
+        draw.rectangle(
+            (x + PADDING, y + PADDING, x + TILE_SIZE - PADDING, y + TILE_SIZE - PADDING),
+            fill=color, outline=TEXT_COLOR
+        )
+        draw.text((x + PADDING * 2, y + PADDING * 2), str(id), fill=TEXT_COLOR, font=self._font)
+        if not is_empty:
+            draw.text((x + PADDING * 2, y + TILE_SIZE // 2), name, fill=TEXT_COLOR, font=self._font)
+
+    def render(self, states: List[TileState]) -> Tuple[str, bytes]:
+        version = self.version(states)
+        if self._png and self._png[0] == version:
+            return self._png
+
+        if self._font is None:
+            self._font = ImageFont.load_default()
+
+        layout = [state[0] for state in states]
+        if layout != self._layout or self._image is None:
+            # Клетки добавились или пропали: сетка сдвинулась, рисуем заново
+            # Большое хозяйство раскладываем ближе к квадрату, а не в длинную ленту
+            self.columns = max(self.min_columns, math.ceil(math.sqrt(len(states))))
+            rows = max(1, math.ceil(len(states) / self.columns))
+            self._image = Image.new("RGB", (self.columns * TILE_SIZE, rows * TILE_SIZE), BACKGROUND_COLOR)
+            self._layout = layout
+            self._tiles = {}
+
+        draw = ImageDraw.Draw(self._image)
+        for index, state in enumerate(states):
+            if self._tiles.get(state[0]) != state:
+                self._draw_tile(draw, index, state)
+                self._tiles[state[0]] = state
+
+        buffer = io.BytesIO()
+        self._image.save(buffer, format="PNG", optimize=True)
+        self._png = (version, buffer.getvalue())
+        return self._png
+
+    async def render_async(self, states: List[TileState]) -> Tuple[str, bytes]:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self.render, states)
@@ -0,0 +1,256 @@
+import csv
+import io
+import json
+import os
+import sys
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, List, Optional, TextIO, Union
+
+from pymongo import UpdateOne
+from pymongo.collection import Collection
+
+from db import close_client, get_db
+from events import state_events
+from rabbit import pedigree_cache, rabbit_cache
+
+FIELDS = ["id", "name", "gender", "is_empty", "last_breeding_date", "father"]
+BATCH_SIZE = 500
+MAX_ERRORS = 50
+
+TRUE_VALUES = {"1", "true", "yes", "да"}
+FALSE_VALUES = {"", "0", "false", "no", "нет"}
+
+
+def _parse_int(value, field: str, required: bool = False) -> Optional[int]:
+    if value is None or value == "":
+        if required:
+            raise ValueError(f"поле {field} обязательно")
+        return None
+    # В JSON встречаются true и 5.5: int() молча превратил бы их в 1 и 5
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ValueError(f"{field} должно быть числом, получено {value!r}")
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f"{field} должно быть числом, получено {value!r}")
+
+
+def _parse_bool(value, field: str) -> bool:
+    if isinstance(value, bool):
+        return value
+    if value is not None and not isinstance(value, (int, str)):
+        raise ValueError(f"{field} должно быть да/нет, получено {value!r}")
+    text = str(value if value is not None else "").strip().lower()
+    if text in TRUE_VALUES:
+        return True
+    if text in FALSE_VALUES:
+        return False
+    raise ValueError(f"{field} должно быть да/нет, получено {value!r}")
+
+
+def _parse_date(value, field: str) -> Optional[datetime]:
+    if value is None or value == "":
+        return None
+    if isinstance(value, datetime):
+        return value
+    if not isinstance(value, str):
+        raise ValueError(f"{field} должно быть датой в формате ГГГГ-ММ-ДД, получено {value!r}")
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f"{field} должно быть датой в формате ГГГГ-ММ-ДД, получено {value!r}")
+
+
+def parse_row(row: Union[Dict, str]) -> Dict:
+    """Проверяет строку импорта и приводит ее к документу коллекции rabbits.
+
+    Строки JSON Lines приходят сырым текстом, чтобы битая строка считалась ошибкой строки, а не всего файла.
+    """
+    if isinstance(row, str):
+        try:
+            row = json.loads(row)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"некорректный JSON: {e.msg}")
+    if not isinstance(row, dict):
+        raise ValueError(f"ожидался объект с полями, получено {type(row).__name__}")
+
+    # Из JSON поля приходят любого типа, и любая ошибка в них должна быть ошибкой строки
+    gender = row.get("gender")
+    if not isinstance(gender, str) or gender.strip() not in ("male", "female"):
+        raise ValueError(f"gender должно быть male или female, получено {gender!r}")
+    gender = gender.strip()
+
+    name = row.get("name")
+    if name is not None and not isinstance(name, str):
+        raise ValueError(f"name должно быть строкой, получено {name!r}")
+
+    return {
+        "id": _parse_int(row.get("id"), "id", required=True),
+        "name": name or "",
+        "gender": gender,
+        "is_empty": _parse_bool(row.get("is_empty"), "is_empty"),
+        "last_breeding_date": _parse_date(row.get("last_breeding_date"), "last_breeding_date"),
+        "father": _parse_int(row.get("father"), "father"),
+    }
+
+
+def read_rows(fp: TextIO, fmt: str) -> Iterator[Union[Dict, str]]:
+    if fmt == "csv":
+        yield from csv.DictReader(fp)
+    elif fmt == "jsonl":
+        for line in fp:
+            if line.strip():
+                yield line
+    elif fmt == "json":
+        try:
+            rows = json.load(fp)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Файл не является JSON: {e.msg}")
+        if not isinstance(rows, list):
+            raise ValueError("JSON-файл должен содержать массив клеток")
+        yield from rows
+    else:
+        raise ValueError(f"Неизвестный формат: {fmt}")
+
+
+def detect_format(filename: str) -> str:
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == ".csv":
+        return "csv"
+    if extension in (".jsonl", ".ndjson"):
+        return "jsonl"
+    if extension == ".json":
+        return "json"
+    raise ValueError(f"Неизвестное расширение файла: {filename}")
+
+
+def import_rows(rows: Iterable[Dict], collection: Optional[Collection] = None,
+                batch_size: int = BATCH_SIZE) -> Dict:
+    collection = collection if collection is not None else get_db().rabbits
+    imported = 0
+    errors: List[str] = []
+    batch: List[Dict] = []
+
+    def flush():
+        nonlocal imported
+        if batch:
+            # Своя отметка времени на каждую пачку, чтобы опрос по updated_at увидел и поздние пачки
+            now = datetime.now()
+            # Прежнее состояние клеток нужно, чтобы записать в журнал только реальные изменения
+            before = {
+                rabbit_data["id"]: rabbit_data
+                for rabbit_data in collection.find(
+                    {"id": {"$in": [rabbit_data["id"] for rabbit_data in batch]}},
+                    {"_id": 0, "id": 1, "name": 1, "is_empty": 1, "last_breeding_date": 1}
+                )
+            }
+            collection.bulk_write([
+                UpdateOne({"id": rabbit_data["id"]}, {"$set": {**rabbit_data, "updated_at": now}}, upsert=True)
+                for rabbit_data in batch
+            ], ordered=False)
+            events = [
+                event
+                for rabbit_data in batch
+                for event in state_events(rabbit_data["id"], before.get(rabbit_data["id"]), rabbit_data, now)
+            ]
+            # Импорт работает и из консоли, где цикла записи журнала нет, поэтому пишем сразу
+            if events:
+                collection.database.events.insert_many(events, ordered=False)
+            imported += len(batch)
+            batch.clear()
+
+    for number, row in enumerate(rows, 1):
+        try:
+            rabbit_data = parse_row(row)
+        except ValueError as e:
+            if len(errors) < MAX_ERRORS:
+                errors.append(f"строка {number}: {e}")
+            continue
+
+        batch.append(rabbit_data)
+        if len(batch) >= batch_size:
+            flush()
+
+    flush()
+    # Импорт мог затронуть любую клетку, поэтому кэши сбрасываем целиком
+    rabbit_cache.clear()
+    pedigree_cache.clear()
+
+    return {"imported": imported, "errors": errors}
+
+
+def export_rows(collection: Optional[Collection] = None) -> Iterator[Dict]:
+    collection = collection if collection is not None else get_db().rabbits
+    projection = {"_id": 0, **{field: 1 for field in FIELDS}}
+    for rabbit_data in collection.find({}, projection).sort("id", 1).batch_size(BATCH_SIZE):
+        yield {field: rabbit_data.get(field) for field in FIELDS}
+
+
+def write_rows(rows: Iterable[Dict], fp: TextIO, fmt: str) -> int:
+    count = 0
+    if fmt == "csv":
+        writer = csv.DictWriter(fp, fieldnames=FIELDS)
+        writer.writeheader()
+        for row in rows:
+            date = row["last_breeding_date"]
+            writer.writerow({
+                **row,
+                "is_empty": "true" if row["is_empty"] else "false",
+                "last_breeding_date": date.isoformat() if date else "",
+                "father": row["father"] if row["father"] is not None else "",
+            })
+            count += 1
+    elif fmt == "jsonl":
+        for row in rows:
+            fp.write(json.dumps(row, ensure_ascii=False, default=lambda d: d.isoformat()) + "\n")
+            count += 1
+    elif fmt == "json":
+        rows = list(rows)
+        json.dump(rows, fp, ensure_ascii=False, indent=1, default=lambda d: d.isoformat())
+        count = len(rows)
+    else:
+        raise ValueError(f"Неизвестный формат: {fmt}")
+    return count
+
+
+def import_file(fp: io.BufferedIOBase, filename: str) -> Dict:
+    with io.TextIOWrapper(fp, encoding="utf-8-sig", newline="") as text:
+        return import_rows(read_rows(text, detect_format(filename)))
+
+
+def export_file(fmt: str = "csv") -> bytes:
+    buffer = io.StringIO()
+    write_rows(export_rows(), buffer, fmt)
+    return buffer.getvalue().encode("utf-8")
+
+
+def main(argv: List[str]):
+    if len(argv) != 3 or argv[1] not in ("import", "export"):
+        print("Использование: python herd_io.py import|export <файл.csv|файл.jsonl|файл.json>")
+        return 1
+
+    command, path = argv[1], argv[2]
+    try:
+        fmt = detect_format(path)
+        if command == "import":
+            with open(path, "rb") as fp:
+                result = import_file(fp, path)
+            print(f"Импортировано клеток: {result['imported']}")
+            for error in result["errors"]:
+                print(f"Ошибка: {error}")
+        else:
+            with open(path, "w", encoding="utf-8", newline="") as fp:
+                count = write_rows(export_rows(), fp, fmt)
+            print(f"Выгружено клеток: {count}")
+    except ValueError as e:
+        print(f"Ошибка: {e}")
+        return 1
+    finally:
+        close_client()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,63 @@
+import hashlib
+import inspect
+import logging
+from typing import Awaitable, Callable, Dict, Optional, Tuple, Union
+
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import FSInputFile, InputFile, Message
+
+from rabbit import AsyncRabbitRepository
+
+SCHEME_PATH = "scheme.png"
+
+
+class PhotoCache:
+    """Загружает картинку в Telegram один раз и дальше отправляет ее по file_id.
+
+    На ключ хранится только последняя версия, поэтому часто меняющиеся картинки
+    (карта фермы) не копят записи ни в памяти, ни в bot_files.
+    """
+
+    def __init__(self, repository: AsyncRabbitRepository):
+        self.repository = repository
+        self._file_ids: Dict[str, Tuple[Optional[str], Optional[str]]] = {}
+        self._path_versions: Dict[str, str] = {}
+
+    def path_version(self, path: str) -> str:
+        # Версия зависит от содержимого, чтобы замена файла вызывала новую загрузку
+        if path not in self._path_versions:
+            with open(path, "rb") as f:
+                self._path_versions[path] = hashlib.sha1(f.read()).hexdigest()
+        return self._path_versions[path]
+
+    async def get_file_id(self, key: str, version: Optional[str] = None) -> Optional[str]:
+        cached = self._file_ids.get(key)
+        if cached is None or cached[0] != version:
+            cached = (version, await self.repository.get_file_id(key, version))
+            self._file_ids[key] = cached
+        return cached[1]
+
+    async def answer_photo(self, message: Message, key: str,
+                           input_file: Callable[[], Union[InputFile, Awaitable[InputFile]]],
+                           version: Optional[str] = None, **kwargs) -> Message:
+        file_id = await self.get_file_id(key, version)
+        if file_id:
+            try:
+                return await message.answer_photo(photo=file_id, **kwargs)
+            except TelegramBadRequest as e:
+                logging.warning(f"file_id для {key} больше не действует, загружаем заново: {e}")
+
+        # Фабрика может быть асинхронной, если файл еще нужно сгенерировать
+        photo = input_file()
+        if inspect.isawaitable(photo):
+            photo = await photo
+        sent = await message.answer_photo(photo=photo, **kwargs)
+        file_id = sent.photo[-1].file_id
+        self._file_ids[key] = (version, file_id)
+        await self.repository.save_file_id(key, file_id, version)
+        return sent
+
+    async def answer_file(self, message: Message, path: str, **kwargs) -> Message:
+        return await self.answer_photo(
+            message, path, lambda: FSInputFile(path), version=self.path_version(path), **kwargs
+        )
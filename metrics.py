@@ -0,0 +1,231 @@
+import bisect
+import contextvars
+import logging
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.types import CallbackQuery, TelegramObject
+from aiohttp import web
+from pymongo import monitoring
+
+from callbacks import CallbackRouter
+
+# Имя обработчика, в котором сейчас выполняется код; попадает и в потоки run_in_db_thread
+current_handler: contextvars.ContextVar[str] = contextvars.ContextVar("current_handler", default="background")
+
+HANDLER_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+MONGO_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Оценка квантиля по верхней границе корзины."""
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            if total >= target:
+                return bound
+        return float("inf")
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.handler_time: Dict[str, Histogram] = defaultdict(lambda: Histogram(HANDLER_BUCKETS))
+        self.handler_errors: Dict[str, int] = defaultdict(int)
+        self.mongo_time: Dict[Tuple[str, str, str], Histogram] = defaultdict(lambda: Histogram(MONGO_BUCKETS))
+        self.mongo_failures: Dict[Tuple[str, str, str], int] = defaultdict(int)
+
+    def observe_handler(self, handler: str, seconds: float, failed: bool = False):
+        with self._lock:
+            self.handler_time[handler].observe(seconds)
+            if failed:
+                self.handler_errors[handler] += 1
+
+    def observe_query(self, handler: str, collection: str, command: str, seconds: float, failed: bool = False):
+        with self._lock:
+            self.mongo_time[(handler, collection, command)].observe(seconds)
+            if failed:
+                self.mongo_failures[(handler, collection, command)] += 1
+
+    def queries_by_handler(self) -> Dict[str, Tuple[int, float]]:
+        result: Dict[str, List[float]] = defaultdict(lambda: [0, 0.0])
+        with self._lock:
+            for (handler, _, _), histogram in self.mongo_time.items():
+                result[handler][0] += histogram.count
+                result[handler][1] += histogram.sum
+        return {handler: (int(count), seconds) for handler, (count, seconds) in result.items()}
+
+    def render(self) -> str:
+        """Текст в формате Prometheus exposition."""
+        lines = []
+        with self._lock:
+            lines += _render_histogram(
+                "rabbit_bot_handler_seconds", "Время работы обработчиков бота",
+                {(("handler", handler),): h for handler, h in self.handler_time.items()}
+            )
+            lines += [
+                "# HELP rabbit_bot_handler_errors_total Исключения в обработчиках",
+                "# TYPE rabbit_bot_handler_errors_total counter",
+            ]
+            lines += [
+                f'rabbit_bot_handler_errors_total{{handler="{handler}"}} {count}'
+                for handler, count in self.handler_errors.items()
+            ]
+            lines += _render_histogram(
+                "rabbit_bot_mongo_seconds", "Время запросов к MongoDB по обработчикам и коллекциям",
+                {
+                    (("handler", handler), ("collection", collection), ("command", command)): h
+                    for (handler, collection, command), h in self.mongo_time.items()
+                }
+            )
+            lines += [
+                "# HELP rabbit_bot_mongo_failures_total Неудачные запросы к MongoDB",
+                "# TYPE rabbit_bot_mongo_failures_total counter",
+            ]
+            lines += [
+                f'rabbit_bot_mongo_failures_total{{handler="{h}",collection="{c}",command="{cmd}"}} {count}'
+                for (h, c, cmd), count in self.mongo_failures.items()
+            ]
+        return "\n".join(lines) + "\n"
+
+
+def _render_histogram(name: str, help_text: str, series: Dict[tuple, Histogram]) -> List[str]:
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+    for labels, histogram in series.items():
+        label_text = ",".join(f'{key}="{value}"' for key, value in labels)
+        cumulative = 0
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{label_text},le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{label_text},le="+Inf"}} {histogram.count}')
+        lines.append(f"{name}_sum{{{label_text}}} {histogram.sum}")
+        lines.append(f"{name}_count{{{label_text}}} {histogram.count}")
+    return lines
+
+
+metrics = Metrics()
+
+
+class MongoMetricsListener(monitoring.CommandListener):
+    # Служебные команды драйвера (hello, ping, endSessions) не считаем
+    COMMANDS = {
+        "find", "findAndModify", "aggregate", "count", "distinct", "getMore",
+        "insert", "update", "delete", "createIndexes",
+    }
+
+    def __init__(self):
+        self._pending: Dict[Tuple[Any, int], Tuple[str, str, str]] = {}
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        if event.command_name not in self.COMMANDS:
+            return
+        collection = event.command.get("collection") if event.command_name == "getMore" \
+            else event.command.get(event.command_name)
+        with self._lock:
+            self._pending[(event.connection_id, event.request_id)] = (
+                current_handler.get(), str(collection), event.command_name
+            )
+
+    def _finish(self, event, failed: bool):
+        with self._lock:
+            labels = self._pending.pop((event.connection_id, event.request_id), None)
+        if labels:
+            metrics.observe_query(*labels, event.duration_micros / 1_000_000, failed=failed)
+
+    def succeeded(self, event):
+        self._finish(event, failed=False)
+
+    def failed(self, event):
+        self._finish(event, failed=True)
+
+
+class HandlerTimingMiddleware(BaseMiddleware):
+    """Замеряет время обработчиков; для кнопок имя берется из таблицы CallbackRouter."""
+
+    def __init__(self, callback_router: Optional[CallbackRouter] = None):
+        self.callback_router = callback_router
+
+    def _handler_name(self, event: TelegramObject, data: Dict[str, Any]) -> str:
+        if self.callback_router and isinstance(event, CallbackQuery):
+            resolved = self.callback_router.resolve(event.data)
+            if resolved:
+                return resolved[1].__name__
+        handler = data.get("handler")
+        return getattr(getattr(handler, "callback", None), "__name__", "unknown")
+
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: Dict[str, Any]) -> Any:
+        name = self._handler_name(event, data)
+        token = current_handler.set(name)
+        started = time.perf_counter()
+        failed = False
+        try:
+            return await handler(event, data)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            metrics.observe_handler(name, time.perf_counter() - started, failed=failed)
+            current_handler.reset(token)
+
+
+def register_mongo_listener():
+    """Регистрировать до создания MongoClient, иначе клиент не увидит слушателя."""
+    monitoring.register(MongoMetricsListener())
+
+
+def format_stats(limit: int = 10) -> str:
+    queries = metrics.queries_by_handler()
+    with metrics._lock:
+        handlers = sorted(metrics.handler_time.items(), key=lambda item: item[1].sum, reverse=True)[:limit]
+
+    if not handlers:
+        return "Статистика пока пуста"
+
+    lines = ["📈 Обработчики (по суммарному времени):"]
+    for name, histogram in handlers:
+        query_count, query_seconds = queries.get(name, (0, 0.0))
+        lines.append(
+            f"• {name}: {histogram.count} выз., "
+            f"ср. {histogram.sum / histogram.count * 1000:.0f} мс, "
+            f"p95 ≤ {histogram.quantile(0.95) * 1000:.0f} мс, "
+            f"запросов к БД {query_count / histogram.count:.1f}/выз. "
+            f"({query_seconds / histogram.count * 1000:.0f} мс)"
+        )
+
+    background = queries.get("background")
+    if background:
+        lines.append(f"\nФоновые задачи: {background[0]} запросов к БД, {background[1] * 1000:.0f} мс")
+    return "\n".join(lines)
+
+
+async def start_metrics_server(host: str, port: int) -> web.AppRunner:
+    async def handle(request: web.Request) -> web.Response:
+        return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f"Метрики доступны на http://{host}:{port}/metrics")
+    return runner
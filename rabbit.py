@@ -1,41 +1,121 @@
-from pymongo.mongo_client import MongoClient
+import functools
+from dataclasses import dataclass
 from datetime import datetime, timedelta
-from typing import List, Dict, Optional, Literal
+from typing import List, Dict, Optional, Literal, Tuple
+
+from pymongo import ReturnDocument
+
+from cache import LRUCache, TTLCache
+from db import get_db, run_in_db_thread
+from events import default_event_log, state_events
 
 Gender = Literal["male", "female"]
 
+BREEDING_INTERVAL = timedelta(days=30)
+PEDIGREE_MAX_DEPTH = 10
+RABBIT_CACHE_SIZE = 1024
+RABBIT_CACHE_TTL = 60
+
+# Документы предков по номеру клетки, сбрасываются при каждой записи кролика
+pedigree_cache = LRUCache(maxsize=2048)
+# Документы клеток для карточек; пустой dict означает, что клетки нет в базе
+rabbit_cache = TTLCache(maxsize=RABBIT_CACHE_SIZE, ttl=RABBIT_CACHE_TTL)
+
+
+def invalidate_rabbit(id: int):
+    rabbit_cache.invalidate(id)
+    pedigree_cache.invalidate(id)
+
+
+def is_ready_for_breeding(last_breeding_date: Optional[datetime]) -> bool:
+    if last_breeding_date is None:
+        return True
+    return datetime.now() - last_breeding_date >= BREEDING_INTERVAL
+
+
+def pregnancy_status(gender: Gender, last_breeding_date: Optional[datetime]) -> Optional[str]:
+    if gender != "female" or not last_breeding_date:
+        return None
+    
+    days_passed = (datetime.now() - last_breeding_date).days
+    if 28 <= days_passed <= 32:
+        return "okrol"
+    elif 25 <= days_passed < 28:
+        return "preparing"
+    return None
+
+
+@dataclass(slots=True)
+class RabbitRecord:
+    """Легкая запись о клетке для списков, подбора пары и уведомлений, без доступа к базе."""
+    id: int
+    name: str = ""
+    gender: Gender = "male"
+    is_empty: bool = True
+    last_breeding_date: Optional[datetime] = None
+    father_id: Optional[int] = None
+
+    @classmethod
+    def from_document(cls, rabbit_data: Dict) -> 'RabbitRecord':
+        return cls(
+            id=rabbit_data["id"],
+            name=rabbit_data.get("name", ""),
+            gender=rabbit_data.get("gender", "male"),
+            is_empty=rabbit_data.get("is_empty", True),
+            last_breeding_date=rabbit_data.get("last_breeding_date"),
+            father_id=rabbit_data.get("father"),
+        )
+
+    def check_rabbit(self) -> bool:
+        return is_ready_for_breeding(self.last_breeding_date)
+
+    def get_pregnancy_status(self) -> Optional[str]:
+        return pregnancy_status(self.gender, self.last_breeding_date)
+
+
 class Rabbit:
-    uri = "mongodb://localhost:27017/"
+    # Атрибут -> поле документа; изменения этих атрибутов запоминаются для save_rabbit
+    TRACKED_FIELDS = {
+        "name": "name",
+        "gender": "gender",
+        "is_empty": "is_empty",
+        "last_breeding_date": "last_breeding_date",
+        "father_id": "father",
+    }
 
     def __init__(self, id):
-        self.mongo_client = MongoClient(self.uri)
-        self.db = self.mongo_client["rabbit_manager"]
-        self.rabbits_data = self.db.rabbits
-
         self.name = ""
         self.id = id
         self.gender: Gender = "male"
         self.is_empty = True
         self.last_breeding_date: Optional[datetime] = None
-        self.father = None
+        self.father_id: Optional[int] = None
+        self._father: Optional['Rabbit'] = None
+        self._stored = False
+        self._dirty = set()
+        # Поля в том виде, в каком они лежат в базе; по ним save_rabbit пишет журнал событий
+        self._saved: Dict = {}
 
-        self.get_rabbit(id)
+        if id is not None:
+            self.get_rabbit(id)
+
+    def __setattr__(self, key, value):
+        field = self.TRACKED_FIELDS.get(key)
+        if field is not None and getattr(self, key, value) != value:
+            self._dirty.add(field)
+        object.__setattr__(self, key, value)
+
+    @classmethod
+    def from_document(cls, rabbit_data: Dict, fathers: Optional[Dict[int, 'Rabbit']] = None) -> 'Rabbit':
+        rabbit = cls(None)
+        rabbit._load(rabbit_data, fathers or {})
+        return rabbit
 
     def get_rabbit(self, id):
-        rabbit_data = self.rabbits_data.find_one({"id": id})
+        rabbit_data = default_repository.get_document(id)
         
         if rabbit_data:
-            self.name = rabbit_data.get("name", "")
-            self.id = rabbit_data["id"]
-            self.gender = rabbit_data.get("gender", "male")
-            self.is_empty = rabbit_data.get("is_empty", True)
-            self.last_breeding_date = rabbit_data.get("last_breeding_date")
-            
-            father_id = rabbit_data.get("father")
-            if father_id:
-                self.father = Rabbit(father_id)
-            else:
-                self.father = None
+            self._load(rabbit_data)
         else:
             self.name = ""
             self.id = id
@@ -43,23 +123,55 @@ class Rabbit:
             self.is_empty = True
             self.last_breeding_date = None
             self.father = None
+            self._stored = False
+            self._dirty = set()
+            self._saved = {}
+
+    def _load(self, rabbit_data: Dict, fathers: Optional[Dict[int, 'Rabbit']] = None):
+        self.name = rabbit_data.get("name", "")
+        self.id = rabbit_data["id"]
+        self.gender = rabbit_data.get("gender", "male")
+        self.is_empty = rabbit_data.get("is_empty", True)
+        self.last_breeding_date = rabbit_data.get("last_breeding_date")
+        self.father_id = rabbit_data.get("father")
+        self._father = fathers.get(self.father_id) if fathers and self.father_id else None
+        self._stored = "_id" in rabbit_data
+        self._dirty = set()
+        self._saved = {field: getattr(self, attr) for attr, field in self.TRACKED_FIELDS.items()}
+
+    @property
+    def father(self) -> Optional['Rabbit']:
+        if self._father is None and self.father_id and self.father_id != self.id:
+            father_data = default_repository.get_pedigree_entry(self.father_id)
+            if father_data:
+                self._father = Rabbit.from_document(father_data)
+        return self._father
+
+    @father.setter
+    def father(self, father: Optional['Rabbit']):
+        self._father = father
+        self.father_id = father.id if father else None
+
+    def get_lineage(self, max_depth: int = PEDIGREE_MAX_DEPTH) -> List['Rabbit']:
+        lineage = []
+        seen = {self.id}
+        father_id = self.father_id
+        
+        # Идем по отцам без рекурсии и останавливаемся на цикле в данных
+        while father_id and father_id not in seen and len(lineage) < max_depth:
+            seen.add(father_id)
+            father_data = default_repository.get_pedigree_entry(father_id)
+            if not father_data:
+                break
+            lineage.append(Rabbit.from_document(father_data))
+            father_id = father_data.get("father")
+        
+        return lineage
 
     def update_rabbit(self, name: str, id: int, gender: Gender, is_empty: bool, date: datetime, 
                     last_breeding_date: Optional[datetime], father: Optional['Rabbit']) -> 'Rabbit':
-        update_data = {
-            "name": name,
-            "id": id,
-            "gender": gender,
-            "is_empty": is_empty,
-            "last_breeding_date": last_breeding_date,
-            "father": father.id if father else None
-        }
-        
-        self.rabbits_data.update_one(
-            {"id": id},
-            {"$set": update_data},
-            upsert=True
-        )
+        if id != self.id:
+            self._stored = False
         
         self.name = name
         self.id = id
@@ -67,31 +179,29 @@ class Rabbit:
         self.is_empty = is_empty
         self.last_breeding_date = last_breeding_date
         self.father = father
+        self.save_rabbit()
         
         return self
 
-    def save_rabbit(self):
-        update_data = {
-            "name": self.name,
-            "id": self.id,
-            "gender": self.gender,
-            "is_empty": self.is_empty,
-            "last_breeding_date": self.last_breeding_date,
-            "father": self.father.id if self.father else None
-        }
+    def save_rabbit(self) -> bool:
+        # Записываем только измененные поля; новую клетку - целиком
+        fields = self.TRACKED_FIELDS.values() if not self._stored else self._dirty
+        if not fields:
+            return False
         
-        self.rabbits_data.update_one(
-            {"id": self.id},
-            {"$set": update_data},
-            upsert=True
-        )
+        values = {field: getattr(self, attr) for attr, field in self.TRACKED_FIELDS.items()}
+        update_data = {field: values[field] for field in fields}
+        update_data["id"] = self.id
+        
+        default_repository.save_fields(self.id, update_data)
+        default_event_log.record_many(state_events(self.id, self._saved if self._stored else None, values))
+        self._stored = True
+        self._dirty = set()
+        self._saved = values
+        return True
 
     def check_rabbit(self) -> bool:
-        if self.last_breeding_date is None:
-            return True
-            
-        time_since_last_breeding = datetime.now() - self.last_breeding_date
-        return time_since_last_breeding >= timedelta(days=30)
+        return is_ready_for_breeding(self.last_breeding_date)
 
     def get_message(self) -> str:
         gender_emoji = "♂️" if self.gender == "male" else "♀️"
@@ -124,12 +234,13 @@ class Rabbit:
             return False
         
         female = self if self.gender == "female" else partner
-        if not female.check_rabbit():
+        male = partner if female is self else self
+        rabbit_data = default_repository.breed_female(female.id)
+        if not rabbit_data:
             return False
         
-        female.last_breeding_date = datetime.now()
-        female.save_rabbit()
-        
+        female._load(rabbit_data)
+        default_event_log.record("breeding", female.id, time=female.last_breeding_date, partner=male.id)
         return True
     
     def reset_breeding(self):
@@ -140,51 +251,327 @@ class Rabbit:
         return False
     
     def get_pregnancy_status(self) -> Optional[str]:
-        if self.gender != "female" or not self.last_breeding_date:
-            return None
-            
-        days_passed = (datetime.now() - self.last_breeding_date).days
-        if 28 <= days_passed <= 32:
-            return "okrol"
-        elif 25 <= days_passed < 28:
-            return "preparing"
-        return None
+        return pregnancy_status(self.gender, self.last_breeding_date)
 
     @classmethod
-    def get_pregnant_females(cls):
-        client = MongoClient(cls.uri)
-        db = client["rabbit_manager"]
-        
-        females = list(db.rabbits.find({
+    def get_pregnant_females(cls) -> List[RabbitRecord]:
+        return default_repository.find_records({
             "gender": "female",
             "is_empty": False,
             "last_breeding_date": {"$ne": None}
-        }))
-        
-        client.close()
-        return [Rabbit(f["id"]) for f in females]
+        })
+    
+    @classmethod
+    def get_herd_summary(cls, limit: int = 20) -> Dict[str, Dict]:
+        return default_repository.get_herd_summary(limit)
     
     @classmethod
     def register_chat(cls, chat_id: int, chat_name: str):
-        client = MongoClient(cls.uri)
-        db = client["rabbit_manager"]
-        chats = db.bot_chats
+        default_bot_repository.register_chat(chat_id, chat_name)
+
+    @classmethod
+    def get_active_chats(cls):
+        return default_bot_repository.get_active_chats()
+
+    @classmethod
+    def deactivate_chat(cls, chat_id: int):
+        default_bot_repository.deactivate_chat(chat_id)
+
+    @classmethod
+    def get_file_id(cls, key: str, version: Optional[str] = None) -> Optional[str]:
+        return default_bot_repository.get_file_id(key, version)
+
+    @classmethod
+    def save_file_id(cls, key: str, file_id: str, version: Optional[str] = None):
+        default_bot_repository.save_file_id(key, file_id, version)
+
+
+class RabbitRepository:
+    """Весь доступ к коллекции rabbits; Rabbit и RabbitRecord сами в базу не ходят."""
+
+    RECORD_PROJECTION = {"_id": 0, "id": 1, "name": 1, "gender": 1, "is_empty": 1, "last_breeding_date": 1, "father": 1}
+
+    @property
+    def rabbits_data(self):
+        return get_db().rabbits
+
+    def save_fields(self, id: int, update_data: Dict):
+        # updated_at нужен наблюдателю за изменениями, когда change streams недоступны
+        self.rabbits_data.update_one(
+            {"id": id},
+            {"$set": {**update_data, "updated_at": datetime.now()}},
+            upsert=True
+        )
+        invalidate_rabbit(id)
+
+    def find_records(self, query: Dict) -> List[RabbitRecord]:
+        return [RabbitRecord.from_document(d) for d in self.rabbits_data.find(query, self.RECORD_PROJECTION)]
+
+    def from_document(self, rabbit_data: Dict, fathers: Optional[Dict[int, Rabbit]] = None) -> Rabbit:
+        return Rabbit.from_document(rabbit_data, fathers)
+
+    def get(self, id: int) -> Rabbit:
+        return Rabbit(id)
+
+    def get_document(self, id: int) -> Optional[Dict]:
+        rabbit_data = rabbit_cache.get(id)
+        if rabbit_data is None:
+            rabbit_data = self.rabbits_data.find_one({"id": id}) or {}
+            rabbit_cache.set(id, rabbit_data)
+        return rabbit_data or None
+
+    def get_many(self, ids: List[int], with_fathers: bool = True) -> List[Rabbit]:
+        ids = list(ids)
+        docs = {d["id"]: d for d in self.rabbits_data.find({"id": {"$in": ids}})}
+        fathers = self.load_fathers(docs.values()) if with_fathers else {}
+        return [self.from_document(docs.get(id, {"id": id}), fathers) for id in ids]
+
+    def find(self, query: Dict, with_fathers: bool = False) -> List[Rabbit]:
+        docs = list(self.rabbits_data.find(query))
+        fathers = self.load_fathers(docs) if with_fathers else {}
+        return [self.from_document(d, fathers) for d in docs]
+
+    def breed_female(self, id: int) -> Optional[Dict]:
+        # Проверка готовности и запись даты случки одним атомарным запросом
+        now = datetime.now()
+        rabbit_data = self.rabbits_data.find_one_and_update(
+            {
+                "id": id,
+                "gender": "female",
+                "is_empty": False,
+                "$or": [
+                    {"last_breeding_date": None},
+                    {"last_breeding_date": {"$lte": now - BREEDING_INTERVAL}}
+                ]
+            },
+            {"$set": {"last_breeding_date": now, "updated_at": now}},
+            return_document=ReturnDocument.AFTER
+        )
+        if rabbit_data:
+            invalidate_rabbit(id)
+        return rabbit_data
+
+    def list_page(self, page: int = 0, page_size: int = 10) -> Tuple[List[RabbitRecord], int]:
+        query = {"is_empty": False}
+        total = self.rabbits_data.count_documents(query)
+        rabbits = [
+            RabbitRecord.from_document(d)
+            for d in self.rabbits_data.find(query, self.RECORD_PROJECTION)
+            .sort("id", 1)
+            .skip(max(page, 0) * page_size)
+            .limit(page_size)
+        ]
+        return rabbits, total
+
+    def load_fathers(self, docs) -> Dict[int, Rabbit]:
+        father_ids = list({d["father"] for d in docs if d.get("father")})
+        if not father_ids:
+            return {}
         
-        chats.update_one(
+        fathers = {}
+        for father_data in self.rabbits_data.find({"id": {"$in": father_ids}}):
+            pedigree_cache.set(father_data["id"], father_data)
+            fathers[father_data["id"]] = self.from_document(father_data)
+        for id in father_ids:
+            if id not in fathers:
+                pedigree_cache.set(id, {})
+        return fathers
+
+    def get_pedigree_entry(self, id: int) -> Optional[Dict]:
+        # Как и в rabbit_cache, пустой словарь - "клетки нет": ссылка на несуществующего
+        # отца (импорт их не проверяет) не должна ходить в базу при каждом чтении .father
+        rabbit_data = pedigree_cache.get(id)
+        if rabbit_data is None:
+            rabbit_data = self.rabbits_data.find_one({"id": id}) or {}
+            pedigree_cache.set(id, rabbit_data)
+        return rabbit_data or None
+
+    def get_ancestors(self, id: int, max_depth: int = PEDIGREE_MAX_DEPTH) -> List[Rabbit]:
+        if max_depth <= 0:
+            return []
+        
+        result = next(self.rabbits_data.aggregate([
+            {"$match": {"id": id}},
+            {"$graphLookup": {
+                "from": "rabbits",
+                "startWith": "$father",
+                "connectFromField": "father",
+                "connectToField": "id",
+                "as": "ancestors",
+                "maxDepth": max_depth - 1,
+                "depthField": "depth"
+            }},
+            {"$project": {"_id": 0, "ancestors": 1}}
+        ]), None)
+        if not result:
+            return []
+        
+        ancestors = []
+        for father_data in sorted(result["ancestors"], key=lambda d: d["depth"]):
+            father_data.pop("depth")
+            if father_data["id"] == id:
+                continue
+            pedigree_cache.set(father_data["id"], father_data)
+            ancestors.append(self.from_document(father_data))
+        return ancestors
+
+    def get_herd_summary(self, limit: int = 20) -> Dict[str, Dict]:
+        # Статусы считаются так же, как в check_rabbit и get_pregnancy_status, но одним запросом в Mongo
+        # Прошедшее время в мс, как timedelta.days в Python; $dateDiff считал бы пересеченные границы часов
+        days = {"$floor": {"$divide": [{"$subtract": [datetime.now(), "$last_breeding_date"]}, 86_400_000]}}
+        pipeline = [
+            {"$match": {"gender": "female", "is_empty": False}},
+            {"$project": {
+                "_id": 0,
+                "id": 1,
+                "name": 1,
+                "days": {"$cond": [{"$ifNull": ["$last_breeding_date", False]}, days, None]}
+            }},
+            {"$addFields": {"status": {"$switch": {
+                "branches": [
+                    {"case": {"$eq": ["$days", None]}, "then": "ready"},
+                    {"case": {"$and": [{"$gte": ["$days", 28]}, {"$lte": ["$days", 32]}]}, "then": "okrol"},
+                    {"case": {"$gte": ["$days", 25]}, "then": "preparing"},
+                ],
+                "default": "bred"
+            }}}},
+            {"$addFields": {"status": {"$cond": [{"$gt": ["$days", 32]}, "ready", "$status"]}}},
+            # Самки на 30-32 день check_rabbit уже считает готовыми, но здесь они остаются в okrol, а не в ready.
+            # days_left у bred и preparing - дней до окрола, у okrol - дней до конца окна окрола
+            {"$addFields": {"days_left": {"$switch": {
+                "branches": [
+                    {"case": {"$eq": ["$status", "okrol"]}, "then": {"$subtract": [32, "$days"]}},
+                    {"case": {"$in": ["$status", ["preparing", "bred"]]}, "then": {"$subtract": [28, "$days"]}},
+                ],
+                "default": 0
+            }}}},
+            {"$sort": {"days_left": 1, "id": 1}},
+            {"$group": {
+                "_id": "$status",
+                "count": {"$sum": 1},
+                "females": {"$push": {"id": "$id", "name": "$name", "days": "$days", "days_left": "$days_left"}}
+            }},
+            {"$project": {"count": 1, "females": {"$slice": ["$females", limit]}}},
+        ]
+        
+        summary = {status: {"count": 0, "females": []} for status in ("ready", "bred", "preparing", "okrol")}
+        for group in self.rabbits_data.aggregate(pipeline):
+            summary[group["_id"]] = {"count": group["count"], "females": group["females"]}
+        return summary
+
+
+default_repository = RabbitRepository()
+
+
+class BotRepository:
+    """Служебные коллекции бота: чаты для рассылки (bot_chats) и file_id картинок (bot_files)."""
+
+    @property
+    def chats_data(self):
+        return get_db().bot_chats
+
+    @property
+    def files_data(self):
+        return get_db().bot_files
+
+    def register_chat(self, chat_id: int, chat_name: str):
+        self.chats_data.update_one(
             {"chat_id": chat_id},
             {"$set": {
                 "chat_id": chat_id,
                 "chat_name": chat_name,
-                "last_active": datetime.now()
+                "last_active": datetime.now(),
+                "is_active": True
             }},
             upsert=True
         )
-        client.close()
 
-    @classmethod
-    def get_active_chats(cls):
-        client = MongoClient(cls.uri)
-        db = client["rabbit_manager"]
-        chats = list(db.bot_chats.find({}))
-        client.close()
-        return [{"chat_id": c["chat_id"], "name": c.get("chat_name", "Без названия")} for c in chats]
\ No newline at end of file
+    def get_active_chats(self) -> List[Dict]:
+        chats = list(self.chats_data.find({"is_active": {"$ne": False}}))
+        return [{"chat_id": c["chat_id"], "name": c.get("chat_name", "Без названия")} for c in chats]
+
+    def deactivate_chat(self, chat_id: int):
+        self.chats_data.update_one({"chat_id": chat_id}, {"$set": {"is_active": False}})
+
+    def get_file_id(self, key: str, version: Optional[str] = None) -> Optional[str]:
+        # {"version": None} совпадает и с записями, где версии нет вовсе
+        file_data = self.files_data.find_one({"key": key, "version": version})
+        return file_data["file_id"] if file_data else None
+
+    def save_file_id(self, key: str, file_id: str, version: Optional[str] = None):
+        # Одна запись на ключ: новая версия картинки заменяет старую
+        self.files_data.update_one(
+            {"key": key},
+            {"$set": {"key": key, "version": version, "file_id": file_id, "updated": datetime.now()}},
+            upsert=True
+        )
+
+
+default_bot_repository = BotRepository()
+
+
+class AsyncRabbitRepository:
+    """Те же операции, что у Rabbit, RabbitRepository и BotRepository, но pymongo выполняется в пуле потоков."""
+
+    def __init__(self, repository: Optional[RabbitRepository] = None, bot_repository: Optional[BotRepository] = None):
+        self.repository = repository or default_repository
+        self.bot_repository = bot_repository or default_bot_repository
+
+    async def run(self, func, *args, **kwargs):
+        return await run_in_db_thread(func, *args, **kwargs)
+
+    def _get(self, id: int) -> Rabbit:
+        rabbit = self.repository.get(id)
+        rabbit.father  # отец нужен карточке, грузим его здесь, а не в event loop
+        return rabbit
+
+    async def get(self, id: int) -> Rabbit:
+        return await self.run(self._get, id)
+
+    async def get_many(self, ids: List[int], with_fathers: bool = True) -> List[Rabbit]:
+        return await self.run(self.repository.get_many, ids, with_fathers)
+
+    async def find(self, query: Dict, with_fathers: bool = False) -> List[Rabbit]:
+        return await self.run(self.repository.find, query, with_fathers)
+
+    async def find_records(self, query: Dict) -> List[RabbitRecord]:
+        return await self.run(self.repository.find_records, query)
+
+    async def list_page(self, page: int = 0, page_size: int = 10) -> Tuple[List[RabbitRecord], int]:
+        return await self.run(self.repository.list_page, page, page_size)
+
+    async def get_ancestors(self, id: int, max_depth: int = PEDIGREE_MAX_DEPTH) -> List[Rabbit]:
+        return await self.run(self.repository.get_ancestors, id, max_depth)
+
+    async def save(self, rabbit: Rabbit) -> bool:
+        return await self.run(rabbit.save_rabbit)
+
+    async def update(self, rabbit: Rabbit, **fields) -> Rabbit:
+        return await self.run(functools.partial(rabbit.update_rabbit, **fields))
+
+    async def breed(self, rabbit: Rabbit, partner: Rabbit) -> bool:
+        return await self.run(rabbit.breed_rabbits, partner)
+
+    async def reset_breeding(self, rabbit: Rabbit) -> bool:
+        return await self.run(rabbit.reset_breeding)
+
+    async def get_pregnant_females(self) -> List[RabbitRecord]:
+        return await self.run(Rabbit.get_pregnant_females)
+
+    async def get_herd_summary(self, limit: int = 20) -> Dict[str, Dict]:
+        return await self.run(self.repository.get_herd_summary, limit)
+
+    async def register_chat(self, chat_id: int, chat_name: str):
+        await self.run(self.bot_repository.register_chat, chat_id, chat_name)
+
+    async def get_active_chats(self) -> List[Dict]:
+        return await self.run(self.bot_repository.get_active_chats)
+
+    async def deactivate_chat(self, chat_id: int):
+        await self.run(self.bot_repository.deactivate_chat, chat_id)
+
+    async def get_file_id(self, key: str, version: Optional[str] = None) -> Optional[str]:
+        return await self.run(self.bot_repository.get_file_id, key, version)
+
+    async def save_file_id(self, key: str, file_id: str, version: Optional[str] = None):
+        await self.run(self.bot_repository.save_file_id, key, file_id, version)
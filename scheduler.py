@@ -0,0 +1,128 @@
+import asyncio
+import heapq
+import logging
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple, Union
+
+from rabbit import AsyncRabbitRepository, Rabbit, RabbitRecord
+
+# Окна совпадают с Rabbit.get_pregnancy_status: preparing на 25-27 день, okrol на 28-32
+PREGNANCY_STAGES = (
+    ("preparing", timedelta(days=25), timedelta(days=28)),
+    ("okrol", timedelta(days=28), timedelta(days=33)),
+)
+MAX_SLEEP = 6 * 60 * 60
+
+
+class PregnancyScheduler:
+    """Держит ближайшие переходы беременности в куче и спит до первого из них."""
+
+    def __init__(self, repository: AsyncRabbitRepository, notify: Callable[[List[str]], Awaitable]):
+        self.repository = repository
+        self.notify = notify
+        self._heap: List[Tuple[datetime, int, str]] = []
+        self._females: Dict[int, Tuple[datetime, str]] = {}
+        self._notified: Set[Tuple[int, datetime, str]] = set()
+        self._wakeup = asyncio.Event()
+
+    async def load(self):
+        females = await self.repository.get_pregnant_females()
+        self._heap = []
+        self._females = {}
+        for female in females:
+            self.schedule(female)
+        # Забываем отправленные уведомления только по самкам, у которых сменилась случка
+        self._notified = {key for key in self._notified if self._females.get(key[0], (None,))[0] == key[1]}
+        self._wakeup.set()
+
+    def schedule(self, rabbit: Union[Rabbit, RabbitRecord]):
+        """Пересчитывает переходы для клетки после случки, сброса или очистки."""
+        pregnant = rabbit.gender == "female" and not rabbit.is_empty and rabbit.last_breeding_date
+        current = self._females.get(rabbit.id)
+        if pregnant and current and current[0] == rabbit.last_breeding_date:
+            # Дата не изменилась: переходы уже в куче, обновляем только имя для уведомлений
+            self._females[rabbit.id] = (current[0], rabbit.name)
+            return
+
+        if current:
+            self._forget_notified(rabbit.id, current[0], (status for status, _, _ in PREGNANCY_STAGES))
+            del self._females[rabbit.id]
+        if pregnant:
+            bred = rabbit.last_breeding_date
+            self._females[rabbit.id] = (bred, rabbit.name)
+            for status, start, _ in PREGNANCY_STAGES:
+                heapq.heappush(self._heap, (bred + start, rabbit.id, status))
+        self._wakeup.set()
+
+    def _forget_notified(self, id: int, bred: datetime, statuses: Iterable[str]):
+        for status in statuses:
+            self._notified.discard((id, bred, status))
+
+    def next_due(self) -> Optional[datetime]:
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now: Optional[datetime] = None) -> List[str]:
+        now = now or datetime.now()
+        notifications = []
+
+        while self._heap and self._heap[0][0] <= now:
+            due, id, status = heapq.heappop(self._heap)
+            female = self._females.get(id)
+            if not female:
+                continue
+
+            bred, name = female
+            stage = next(s for s in PREGNANCY_STAGES if s[0] == status)
+            # Запись устарела: дату случки поменяли или окно уже закрылось
+            if bred + stage[1] != due or now >= bred + stage[2] or (id, bred, status) in self._notified:
+                continue
+
+            # Окно прошлого этапа уже закрыто, помнить о его уведомлении больше незачем
+            self._forget_notified(id, bred, (s[0] for s in PREGNANCY_STAGES if s[1] < stage[1]))
+            self._notified.add((id, bred, status))
+            notifications.append(self.format_notification(id, name, bred, status, now))
+
+        return notifications
+
+    @staticmethod
+    def format_notification(id: int, name: str, bred: datetime, status: str, now: datetime) -> str:
+        if status == "okrol":
+            return (
+                f"⚠️ Самка {name} (клетка {id}) должна окролиться "
+                f"в ближайшие дни! (последняя случка {bred.strftime('%Y-%m-%d')})"
+            )
+        days_left = 28 - (now - bred).days
+        return (
+            f"ℹ️ Самка {name} (клетка {id}) готовится к окролу. "
+            f"До родов осталось ~{days_left} дней."
+        )
+
+    async def run(self):
+        while True:
+            try:
+                await self.load()
+                break
+            except Exception as e:
+                logging.error(f"Ошибка при загрузке беременных самок: {e}")
+                await asyncio.sleep(60)
+
+        while True:
+            try:
+                self._wakeup.clear()
+                notifications = self.pop_due()
+                if notifications:
+                    await self.notify(notifications)
+
+                timeout = MAX_SLEEP
+                next_due = self.next_due()
+                if next_due:
+                    timeout = min(max((next_due - datetime.now()).total_seconds(), 0), MAX_SLEEP)
+
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+
+            except Exception as e:
+                logging.error(f"Ошибка в планировщике уведомлений: {e}")
+                await asyncio.sleep(60)
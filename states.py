@@ -0,0 +1,128 @@
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+from pymongo import ASCENDING
+
+from cache import TTLCache
+from db import get_db, run_in_db_thread
+
+STATE_TTL = 60 * 60
+MEMORY_STATES_LIMIT = 10000
+
+
+class StateStorage(ABC):
+    """Хранилище шагов диалогов (добавление кролика, выбор пары) по id пользователя."""
+
+    async def setup(self):
+        pass
+
+    @abstractmethod
+    async def get(self, user_id: int) -> Optional[Dict]:
+        ...
+
+    @abstractmethod
+    async def set(self, user_id: int, data: Dict):
+        ...
+
+    @abstractmethod
+    async def delete(self, user_id: int):
+        ...
+
+
+class MemoryStateStorage(StateStorage):
+    def __init__(self, maxsize: int = MEMORY_STATES_LIMIT, ttl: float = STATE_TTL):
+        self._states = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    async def get(self, user_id: int) -> Optional[Dict]:
+        data = self._states.get(user_id)
+        return dict(data) if data is not None else None
+
+    async def set(self, user_id: int, data: Dict):
+        self._states.set(user_id, dict(data))
+
+    async def delete(self, user_id: int):
+        self._states.invalidate(user_id)
+
+
+class MongoStateStorage(StateStorage):
+    """Состояния в коллекции user_states; просроченные удаляет TTL-индекс по updated_at."""
+
+    def __init__(self, ttl: float = STATE_TTL):
+        self.ttl = ttl
+
+    @property
+    def states_data(self):
+        return get_db().user_states
+
+    def _ensure_indexes(self):
+        self.states_data.create_index([("user_id", ASCENDING)], unique=True, name="user_id_unique")
+        self.states_data.create_index(
+            [("updated_at", ASCENDING)], expireAfterSeconds=int(self.ttl), name="updated_at_ttl"
+        )
+
+    async def setup(self):
+        await run_in_db_thread(self._ensure_indexes)
+
+    def _get(self, user_id: int) -> Optional[Dict]:
+        # TTL-монитор Mongo чистит раз в минуту, поэтому срок проверяем и здесь (время в UTC, как у TTL-индекса)
+        state_data = self.states_data.find_one({
+            "user_id": user_id,
+            "updated_at": {"$gt": datetime.now(timezone.utc) - timedelta(seconds=self.ttl)}
+        })
+        return state_data["data"] if state_data else None
+
+    def _set(self, user_id: int, data: Dict):
+        self.states_data.update_one(
+            {"user_id": user_id},
+            {"$set": {"user_id": user_id, "data": data, "updated_at": datetime.now(timezone.utc)}},
+            upsert=True
+        )
+
+    def _delete(self, user_id: int):
+        self.states_data.delete_one({"user_id": user_id})
+
+    async def get(self, user_id: int) -> Optional[Dict]:
+        return await run_in_db_thread(self._get, user_id)
+
+    async def set(self, user_id: int, data: Dict):
+        await run_in_db_thread(self._set, user_id, data)
+
+    async def delete(self, user_id: int):
+        await run_in_db_thread(self._delete, user_id)
+
+
+def create_state_storage(kind: str) -> StateStorage:
+    if kind == "mongo":
+        return MongoStateStorage()
+    if kind == "memory":
+        return MemoryStateStorage()
+    raise ValueError(f"Неизвестное хранилище состояний: {kind}")
+
+
+class UserStateMiddleware(BaseMiddleware):
+    """Внешний middleware: читает состояние пользователя один раз на событие и кладет его в data["user_state"].
+
+    Фильтры in_state сверяются с ним, поэтому при хранилище в Mongo на сообщение приходится
+    один запрос, а не по запросу на каждый обработчик с фильтром.
+    """
+
+    def __init__(self, storage: StateStorage):
+        self.storage = storage
+
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: Dict[str, Any]) -> Any:
+        user = data.get("event_from_user")
+        data["user_state"] = await self.storage.get(user.id) if user else None
+        return await handler(event, data)
+
+
+def in_state(state):
+    """Фильтр aiogram: пропускает событие, если пользователь на шаге state. Нужен UserStateMiddleware."""
+
+    def check(event, user_state: Optional[Dict] = None) -> bool:
+        return bool(user_state) and user_state.get("state") == state
+
+    return check
@@ -0,0 +1,93 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.types import CallbackQuery, TelegramObject
+
+from broadcast import TokenBucket
+from cache import LRUCache
+
+USER_CALLBACK_RATE = 3
+USER_CALLBACK_BURST = 5
+THROTTLED_TEXT = "Слишком много нажатий, подождите секунду"
+
+CallbackKey = Tuple[int, int, str]
+
+
+class CallbackCoalescingMiddleware(BaseMiddleware):
+    """Склеивает одинаковые нажатия на одном сообщении и ограничивает частоту нажатий пользователя.
+
+    Пока обработчик кнопки работает, повторные нажатия сразу получают callback.answer()
+    и ждут его результат вместо нового запуска с запросами к базе. После ответа нажатие
+    снова запускает обработчик: все экраны редактируют одно сообщение, и та же кнопка
+    через секунду - это обычная навигация, а не дубль.
+    """
+
+    def __init__(self, rate: float = USER_CALLBACK_RATE, burst: float = USER_CALLBACK_BURST):
+        self.rate = rate
+        self.burst = burst
+        self._inflight: Dict[CallbackKey, asyncio.Future] = {}
+        self._user_buckets = LRUCache(maxsize=10000)
+
+    @staticmethod
+    def _key(event: CallbackQuery) -> Optional[CallbackKey]:
+        if event.message is None or event.data is None:
+            return None
+        return event.message.chat.id, event.message.message_id, event.data
+
+    def _user_bucket(self, user_id: int) -> TokenBucket:
+        bucket = self._user_buckets.get(user_id)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, capacity=self.burst)
+            self._user_buckets.set(user_id, bucket)
+        return bucket
+
+    async def _join(self, event: CallbackQuery, future: asyncio.Future) -> Any:
+        await event.answer()
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            if future.cancelled():
+                return None
+            raise
+        except Exception:
+            # Ошибку уже залогировал первый обработчик
+            return None
+
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: Dict[str, Any]) -> Any:
+        if not isinstance(event, CallbackQuery):
+            return await handler(event, data)
+
+        key = self._key(event)
+        if key is not None:
+            future = self._inflight.get(key)
+            if future is not None:
+                logging.debug(f"Склеили повторное нажатие {event.data}")
+                return await self._join(event, future)
+
+        if not self._user_bucket(event.from_user.id).try_acquire():
+            await event.answer(THROTTLED_TEXT)
+            return None
+
+        if key is None:
+            return await handler(event, data)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            result = await handler(event, data)
+        except Exception as e:
+            future.set_exception(e)
+            # Исключение ждут только дубли, а у них оно перехватывается
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            # Обработчик отменили: дубли не должны ждать вечно
+            if not future.done():
+                future.cancel()
+            del self._inflight[key]
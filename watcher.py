@@ -0,0 +1,147 @@
+import asyncio
+import logging
+import threading
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple, Union
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+from cache import LRUCache
+from db import get_db, run_in_db_thread
+from rabbit import RabbitRepository
+
+POLL_INTERVAL = 5
+# updated_at ставится до записи, и пачка импорта может закоммититься позже более новых записей.
+# Опрос перечитывает это окно позади последней увиденной отметки, чтобы их не пропустить
+POLL_LOOKBACK = 60
+RETRY_INTERVAL = 5
+OPEN_CARDS_LIMIT = 1000
+# Standalone mongod без oplog: "The $changeStream stage is only supported on replica sets"
+CHANGE_STREAM_UNSUPPORTED = {40573}
+
+Subscriber = Callable[[Dict], Union[Awaitable, None]]
+
+
+class EventBus:
+    """Раздает документы измененных клеток подписчикам внутри процесса."""
+
+    def __init__(self):
+        self._subscribers: List[Subscriber] = []
+
+    def subscribe(self, callback: Subscriber) -> Subscriber:
+        self._subscribers.append(callback)
+        return callback
+
+    async def publish(self, rabbit_data: Dict):
+        for callback in self._subscribers:
+            try:
+                result = callback(rabbit_data)
+                if asyncio.iscoroutine(result):
+                    await result
+            except Exception as e:
+                logging.error(f"Ошибка подписчика {callback.__name__} на клетку {rabbit_data.get('id')}: {e}")
+
+
+class ChangeWatcher:
+    """Следит за коллекцией rabbits через change stream, а без oplog - опросом по updated_at."""
+
+    PIPELINE = [{"$match": {"operationType": {"$in": ["insert", "update", "replace"]}}}]
+
+    def __init__(self, bus: EventBus, poll_interval: float = POLL_INTERVAL, lookback: float = POLL_LOOKBACK):
+        self.bus = bus
+        self.poll_interval = poll_interval
+        self.lookback = timedelta(seconds=max(lookback, 3 * poll_interval))
+        self.mode: Optional[str] = None
+        self._stop = threading.Event()
+
+    @property
+    def collection(self):
+        return get_db().rabbits
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        try:
+            self.mode = "change_stream"
+            await loop.run_in_executor(None, self._watch, loop)
+        except (OperationFailure, NotImplementedError) as e:
+            logging.warning(f"Change streams недоступны ({e}), опрашиваем updated_at каждые {self.poll_interval} с")
+            self.mode = "polling"
+            await self._poll()
+        except asyncio.CancelledError:
+            # Поток с курсором сам выйдет после ближайшего max_await_time_ms
+            self._stop.set()
+            raise
+
+    def _watch(self, loop: asyncio.AbstractEventLoop):
+        resume_token = None
+        while not self._stop.is_set():
+            try:
+                with self.collection.watch(
+                    self.PIPELINE,
+                    full_document="updateLookup",
+                    resume_after=resume_token,
+                    max_await_time_ms=1000
+                ) as stream:
+                    logging.info("Подписались на change stream коллекции rabbits")
+                    while not self._stop.is_set() and stream.alive:
+                        change = stream.try_next()
+                        resume_token = stream.resume_token
+                        # При updateLookup документа может уже не быть, если его успели удалить
+                        if change and change.get("fullDocument"):
+                            asyncio.run_coroutine_threadsafe(self.bus.publish(change["fullDocument"]), loop)
+            except OperationFailure as e:
+                if e.code in CHANGE_STREAM_UNSUPPORTED:
+                    raise
+                logging.error(f"Change stream прерван: {e}")
+                self._stop.wait(RETRY_INTERVAL)
+            except PyMongoError as e:
+                logging.error(f"Change stream прерван: {e}")
+                self._stop.wait(RETRY_INTERVAL)
+
+    def _changed_since(self, since: datetime) -> List[Dict]:
+        return list(
+            self.collection.find(
+                {"updated_at": {"$gte": since}},
+                {**RabbitRepository.RECORD_PROJECTION, "_id": 1, "updated_at": 1}
+            ).sort("updated_at", 1)
+        )
+
+    async def _poll(self):
+        # Точность зависит от часов процессов, которые пишут updated_at; для фермы этого хватает
+        latest = datetime.now()
+        # Каждый опрос перечитывает окно lookback до последней увиденной отметки: запись
+        # с меньшей отметкой могла закоммититься уже после прошлого опроса. Повторы
+        # внутри окна отсекаем по (_id, updated_at)
+        seen: Set[Tuple[object, datetime]] = set()
+        while not self._stop.is_set():
+            await asyncio.sleep(self.poll_interval)
+            since = latest - self.lookback
+            try:
+                changed = await run_in_db_thread(self._changed_since, since)
+            except PyMongoError as e:
+                logging.error(f"Ошибка при опросе изменений: {e}")
+                continue
+            seen = {item for item in seen if item[1] >= since}
+            for rabbit_data in changed:
+                key = (rabbit_data.pop("_id"), rabbit_data["updated_at"])
+                if key in seen:
+                    continue
+                seen.add(key)
+                latest = max(latest, rabbit_data["updated_at"])
+                await self.bus.publish(rabbit_data)
+
+
+class OpenCards:
+    """Открытые карточки клеток: (chat_id, message_id) -> клетка, самые старые вытесняются."""
+
+    def __init__(self, maxsize: int = OPEN_CARDS_LIMIT):
+        self._cards = LRUCache(maxsize)
+
+    def track(self, chat_id: int, message_id: int, id: int):
+        self._cards.set((chat_id, message_id), id)
+
+    def forget(self, chat_id: int, message_id: int):
+        self._cards.invalidate((chat_id, message_id))
+
+    def messages_for(self, id: int) -> List[Tuple[int, int]]:
+        return [key for key, card_id in self._cards.items() if card_id == id]
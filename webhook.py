@@ -0,0 +1,98 @@
+import asyncio
+import hmac
+import logging
+import signal
+from typing import List, Optional
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from aiohttp import web
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+SHUTDOWN_TIMEOUT = 30
+
+
+class WebhookServer:
+    """Принимает апдейты от Telegram по HTTP и обрабатывает их ограниченным числом воркеров."""
+
+    def __init__(self, dp: Dispatcher, bot: Bot, path: str = "/webhook",
+                 secret_token: Optional[str] = None, workers: int = 8, queue_size: int = 100):
+        # Без секрета любой, кто знает адрес, может слать боту поддельные апдейты
+        if not secret_token:
+            raise ValueError("Для webhook нужен secret_token")
+        self.dp = dp
+        self.bot = bot
+        self.path = path
+        self.secret_token = secret_token
+        self.workers = workers
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self._tasks: List[asyncio.Task] = []
+
+    async def handle(self, request: web.Request) -> web.Response:
+        token = request.headers.get(SECRET_HEADER, "")
+        if not hmac.compare_digest(token.encode(), self.secret_token.encode()):
+            return web.Response(status=401)
+
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": self.bot})
+        except Exception as e:
+            logging.warning(f"Некорректный апдейт в webhook: {e}")
+            return web.Response(status=400)
+
+        # Если очередь полна, ответ задерживается и Telegram сам притормаживает отправку
+        await self.queue.put(update)
+        return web.Response()
+
+    async def _worker(self):
+        while True:
+            update = await self.queue.get()
+            try:
+                await self.dp.feed_update(self.bot, update)
+            except Exception as e:
+                logging.error(f"Ошибка при обработке апдейта {update.update_id}: {e}")
+            finally:
+                self.queue.task_done()
+
+    async def _on_startup(self, app: web.Application):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def _on_shutdown(self, app: web.Application):
+        try:
+            await asyncio.wait_for(self.queue.join(), SHUTDOWN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logging.warning(f"Не дождались обработки {self.queue.qsize()} апдейтов при остановке")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        app.on_startup.append(self._on_startup)
+        app.on_shutdown.append(self._on_shutdown)
+        return app
+
+    async def run(self, host: str, port: int, webhook_url: Optional[str] = None):
+        runner = web.AppRunner(self.create_app())
+        await runner.setup()
+        site = web.TCPSite(runner, host, port)
+        await site.start()
+        logging.info(f"Webhook слушает {host}:{port}{self.path}")
+
+        if webhook_url:
+            await self.bot.set_webhook(webhook_url, secret_token=self.secret_token)
+
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop.set)
+            except NotImplementedError:
+                pass
+
+        try:
+            await stop.wait()
+        finally:
+            await runner.cleanup()
+            await self.bot.session.close()